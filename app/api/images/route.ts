@@ -3,9 +3,43 @@ import { writeFile, readFile } from 'fs/promises';
 import { join } from 'path';
 import { openDb, UPLOADS_DIR, getImagePath } from '@/app/lib/db';
 
+const CONTENT_TYPES: Record<string, string> = {
+    png: 'image/png',
+    webp: 'image/webp',
+    jpg: 'image/jpeg',
+    jpeg: 'image/jpeg',
+};
+
+const contentTypeFor = (path: string) =>
+    CONTENT_TYPES[path.split('.').pop()?.toLowerCase() ?? ''] ?? 'image/jpeg';
+
+// Smallest resized variant (written by the Python insertion pipeline) that is at
+// least `width` pixels wide, preferring WebP when the browser accepts it.
+const findVariantPath = async (imagePath: string, width: number, acceptsWebp: boolean) => {
+    const db = await openDb();
+    try {
+        const variant = await db.get(
+            `SELECT v.image_path
+             FROM CatalogImageVariants v
+             JOIN CatalogImages ci ON ci.id = v.catalog_image_id
+             WHERE ci.image_path = ? AND v.width >= ? AND (v.format = 'jpeg' OR ?)
+             ORDER BY v.width ASC, v.format = 'webp' DESC
+             LIMIT 1`,
+            [imagePath, width, acceptsWebp ? 1 : 0]
+        );
+        return variant?.image_path as string | undefined;
+    } catch (error) {
+        // CatalogImageVariants does not exist until the insertion pipeline has run.
+        return undefined;
+    } finally {
+        await db.close();
+    }
+};
+
 export async function GET(request: Request) {
     const { searchParams } = new URL(request.url);
     const path = searchParams.get('path');
+    const width = Number(searchParams.get('w'));
     
     if (!path) {
         console.error('No image path provided');
@@ -13,17 +47,24 @@ export async function GET(request: Request) {
     }
 
     try {
+        // Serve a resized variant when a display width is requested and one exists.
+        let servedPath = path;
+        if (width > 0) {
+            const acceptsWebp = (request.headers.get('accept') ?? '').includes('image/webp');
+            servedPath = (await findVariantPath(path, width, acceptsWebp)) ?? path;
+        }
+
         // Get the actual filesystem path
-        const fullPath = getImagePath(path);
+        const fullPath = getImagePath(servedPath);
         console.log('Reading image from:', fullPath);
         
         const imageBuffer = await readFile(fullPath);
-        const contentType = path.toLowerCase().endsWith('.png') ? 'image/png' : 'image/jpeg';
         
         return new NextResponse(imageBuffer, {
             headers: {
-                'Content-Type': contentType,
+                'Content-Type': contentTypeFor(servedPath),
                 'Cache-Control': 'public, max-age=31536000, immutable',
+                'Vary': 'Accept',
             },
         });
     } catch (error) {
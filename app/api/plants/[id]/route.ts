@@ -9,11 +9,27 @@ const openDb = async () => {
     });
 };
 
+// Images with the header metadata (width, height, format, bytes) recorded by the
+// Python insertion pipeline, when the CatalogImageMetadata table exists.
+const getImages = async (db: Awaited<ReturnType<typeof openDb>>, plantId: string) => {
+    try {
+        return await db.all(
+            `SELECT ci.*, m.width, m.height, m.format, m.bytes
+             FROM CatalogImages ci
+             LEFT JOIN CatalogImageMetadata m ON m.catalog_image_id = ci.id
+             WHERE ci.plantcatalog_id = ?`,
+            [plantId]
+        );
+    } catch (error) {
+        return db.all('SELECT * FROM CatalogImages WHERE plantcatalog_id = ?', [plantId]);
+    }
+};
+
 export async function GET(request: Request, context: { params: { id: string } }) {
     const db = await openDb();
     try {
         const plant = await db.get('SELECT * FROM PlantCatalog WHERE id = ?', [context.params.id]);
-        const images = await db.all('SELECT * FROM CatalogImages WHERE plantcatalog_id = ?', [context.params.id]);
+        const images = await getImages(db, context.params.id);
         return NextResponse.json({ plant, images });
     } catch (error) {
         console.error('Database error:', error);
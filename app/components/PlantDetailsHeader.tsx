@@ -7,7 +7,7 @@ const PlantDetailsHeader = ({ plant }: { plant: PlantCatalog }) => {
     const imageUrl = (() => {
         const path = plant.images?.[0]?.image_path;
         if (!path) return fallbackImageUrl;
-        return `/api/images?path=${encodeURIComponent(path)}`;
+        return `/api/images?path=${encodeURIComponent(path)}&w=200`;
     })();
 
     return (
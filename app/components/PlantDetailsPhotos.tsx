@@ -30,10 +30,12 @@ const PlantDetailsPhotos: React.FC<PlantDetailsPhotosProps> = ({
                     {images.map((image) => (
                         <div key={image.id} className="relative">
                             <Image
-                                src={`/api/images?path=${encodeURIComponent(image.image_path)}`}
+                                src={`/api/images?path=${encodeURIComponent(image.image_path)}&w=1200`}
                                 alt={image.caption || 'Plant image'}
                                 width={800}
-                                height={600}
+                                height={image.width && image.height
+                                    ? Math.round((800 * image.height) / image.width)
+                                    : 600}
                                 className="object-contain"
                             />
                             {image.caption && (
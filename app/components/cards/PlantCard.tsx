@@ -17,7 +17,7 @@ const PlantCard: React.FC<PlantCardProps> = ({ plant }) => {
     const [imageUrl, setImageUrl] = useState(() => {
         const path = plant.images?.[0]?.image_path;
         if (!path) return fallbackImageUrl;
-        return `/api/images?path=${encodeURIComponent(path)}`;
+        return `/api/images?path=${encodeURIComponent(path)}&w=600`;
     });
     const [imageError, setImageError] = useState(false);
     const [isDragging, setIsDragging] = useState(false);
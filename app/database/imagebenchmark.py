@@ -0,0 +1,370 @@
+#!/usr/bin/env python
+"""
+Synthetic-data benchmark for the plant image matching pipeline.
+
+Generates a PlantCatalog database with realistic-looking genus / cultivar /
+hybrid "x" names and a matching png/<Genus>/[<Cultivar>/]<file>.png tree of
+placeholder images, then measures each stage:
+
+  - extract_file_key       key extraction only
+  - match_keys (pairwise)  the old per-record SequenceMatcher scan
+  - find_candidate_record  the indexed lookup used by the pipeline
+  - rename                 imagepipeline.process_directories
+  - insert                 imagepipeline.process_images_insertion
+
+For every stage it reports files/sec, peak Python memory (tracemalloc; pool
+workers are not included) and, for the matching stages, the share of files
+matched uniquely to the record they were generated from.
+
+    python app/database/imagebenchmark.py --rows 1000 10000 100000 [--json results.json]
+"""
+
+import argparse
+import io
+import json
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from imagematching import (
+    CandidateIndex,
+    extract_candidate_key,
+    extract_file_key,
+    find_candidate_record,
+    get_genus_and_cultivar_from_path,
+    load_db_records,
+    match_keys,
+    normalize,
+)
+import imagepipeline
+
+# A valid 1x1 PNG; used for every placeholder file unless --distinct-images is given.
+PLACEHOLDER_PNG = bytes.fromhex(
+    "89504e470d0a1a0a0000000d4948445200000001000000010806000000"
+    "1f15c4890000000d49444154789c6360f8cfc0f01f0005000201e2213bc0"
+    "0000000049454e44ae426082"
+)
+
+# --distinct-images writes photo-sized images (derivatives are only made for
+# widths up to the original's), drawn from a pool of this many distinct ones so
+# generating them stays cheap; before the insert stage every
+# NEAR_DUPLICATE_EVERY-th renamed file gets a slightly brightened copy under
+# copies/, which dedupe should skip.
+DISTINCT_IMAGE_SIZE = (1280, 960)
+DISTINCT_IMAGE_POOL = 64
+NEAR_DUPLICATE_EVERY = 10
+
+# Syllables without "x", so the only "x" in a botanical name is the hybrid marker.
+SYLLABLES = ["an", "ise", "ca", "mel", "li", "a", "hy", "dran", "ge", "ro", "sa", "vi",
+             "bur", "num", "az", "ale", "il", "ic", "um", "lo", "ra", "pet", "al",
+             "mag", "no", "ber", "be", "ris", "spi", "rea", "hol", "ly", "fern", "cle"]
+CULTIVAR_WORDS = ["pink", "perfection", "yellow", "banana", "split", "ruby", "slipper",
+                  "little", "lime", "king", "queen", "snow", "flake", "gold", "dwarf",
+                  "early", "autumn", "fire", "sunset", "blue", "moon", "crimson", "star",
+                  "white", "cloud", "lady", "diva", "compact", "velvet", "bloom"]
+# Genera that use cultivar subfolders, like png/Camellia/Japonica/.
+SUBFOLDER_GENUS = "Camellia"
+SUBFOLDER_SPECIES = ["Japonica", "Sasanqua"]
+
+# -------------------------------------------------------------------
+# 1. Synthetic Data
+# -------------------------------------------------------------------
+def _word(rng, parts=(2, 3)):
+    return "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(*parts)))
+
+def _mutate(rng, text):
+    """Drop or swap one character, like a typo in a vendor filename."""
+    if len(text) < 4:
+        return text
+    i = rng.randrange(1, len(text) - 1)
+    if rng.random() < 0.5:
+        return text[:i] + text[i + 1:]
+    return text[:i - 1] + text[i] + text[i - 1] + text[i + 1:]
+
+def generate_catalog(rows, seed=0):
+    """
+    Return a list of synthetic records. Each record also carries the
+    relative png path of the file generated for it ('file').
+    """
+    rng = random.Random(seed)
+    genus_count = max(5, rows // 40)
+    genera = set()
+    while len(genera) < genus_count:
+        genera.add(_word(rng).capitalize())
+    genera = sorted(genera) + [SUBFOLDER_GENUS]
+
+    records = []
+    seen = set()
+    while len(records) < rows:
+        genus = rng.choice(genera)
+        cultivar = " ".join(rng.choice(CULTIVAR_WORDS).capitalize()
+                            for _ in range(rng.randint(1, 3)))
+        if genus == SUBFOLDER_GENUS:
+            species = rng.choice(SUBFOLDER_SPECIES)
+            botanical = f"{genus} {species.lower()}"
+            folder = os.path.join(genus, species)
+        elif rng.random() < 0.15:
+            species = _word(rng)
+            botanical = f"{genus} x {species}"
+            folder = genus
+        else:
+            species = None
+            botanical = f"{genus} {_word(rng)}"
+            folder = genus
+        if (genus, cultivar, botanical) in seen:
+            continue
+        seen.add((genus, cultivar, botanical))
+
+        record = {'id': len(records) + 1, 'tag_name': f"{genus} {cultivar}", 'botanical': botanical}
+        name = normalize(cultivar)
+        if species and " x " in botanical:
+            name += normalize(species)
+        if rng.random() < 0.3:
+            name = _mutate(rng, name)
+        if genus != SUBFOLDER_GENUS:
+            name = normalize(genus) + name
+        record['file'] = os.path.join(folder, f"{name}.png")
+        records.append(record)
+    return records
+
+def write_catalog_db(db_path, records):
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE TABLE PlantCatalog (id INTEGER PRIMARY KEY, tag_name TEXT, botanical TEXT)")
+    conn.execute("CREATE TABLE CatalogImages (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                 "plantcatalog_id INTEGER, image_path TEXT, caption TEXT)")
+    conn.executemany("INSERT INTO PlantCatalog (id, tag_name, botanical) VALUES (?, ?, ?)",
+                     [(r['id'], r['tag_name'], r['botanical']) for r in records])
+    conn.commit()
+    conn.close()
+
+def distinct_png_pool(seed=0, count=DISTINCT_IMAGE_POOL, size=DISTINCT_IMAGE_SIZE):
+    """
+    Return `count` encoded PNGs of the given size: random 8x6 colour grids
+    scaled up smoothly, so they look nothing alike to dHash but compress well.
+    """
+    from PIL import Image
+    rng = random.Random(seed)
+    pool = []
+    for _ in range(count):
+        grid = Image.frombytes("RGB", (8, 6), bytes(rng.randrange(256) for _ in range(8 * 6 * 3)))
+        out = io.BytesIO()
+        grid.resize(size, Image.BICUBIC).save(out, "PNG", compress_level=1)
+        pool.append(out.getvalue())
+    return pool
+
+def write_png_tree(png_dir, records, distinct_images=False, seed=0):
+    """Write one PNG per record; returns {file path: record id}."""
+    truth = {}
+    pool = distinct_png_pool(seed) if distinct_images else [PLACEHOLDER_PNG]
+    for record in records:
+        path = os.path.join(png_dir, record['file'])
+        if path in truth:
+            continue  # two records generated the same filename; keep the first
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(pool[len(truth) % len(pool)])
+        truth[path] = record['id']
+    return truth
+
+def write_near_duplicates(png_dir, every=NEAR_DUPLICATE_EVERY):
+    """
+    Copy every `every`-th renamed file, slightly brightened, to copies/ next
+    to it (same plant, different path). Returns the number of copies.
+    """
+    from PIL import Image
+    files = sorted(imagepipeline.collect_insertable_files(png_dir))[::every]
+    for path in files:
+        copy_dir = os.path.join(os.path.dirname(path), "copies")
+        os.makedirs(copy_dir, exist_ok=True)
+        with Image.open(path) as img:
+            img.point(lambda v: min(255, v + 6)).save(
+                os.path.join(copy_dir, os.path.basename(path)), "PNG", compress_level=1)
+    return len(files)
+
+# -------------------------------------------------------------------
+# 2. Measurement
+# -------------------------------------------------------------------
+def measure(stage, func, files, setup=None):
+    """
+    Time func() and return a result dict for the stage; func's return value
+    is the stage accuracy (or None).
+
+    Peak memory comes from a second, untimed run under tracemalloc, because
+    tracing slows Python code down several times. setup(), if given, runs
+    untimed before each run (e.g. to restore files a stage renames).
+    """
+    if setup:
+        setup()
+    started = time.perf_counter()
+    accuracy = func()
+    seconds = time.perf_counter() - started
+
+    if setup:
+        setup()
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'stage': stage,
+        'files': files,
+        'seconds': round(seconds, 4),
+        'files_per_sec': round(files / seconds, 1) if seconds > 0 else None,
+        'peak_mb': round(peak / 2 ** 20, 2),
+        'accuracy': None if accuracy is None else round(accuracy, 4),
+    }
+
+def pairwise_candidates(file_key, genus, cultivar, db_records):
+    """The original linear find_candidate_record scan, kept as the baseline."""
+    candidates = []
+    for record in db_records:
+        botanical_value = (record.get('botanical') or "").lower()
+        tag_name_value = (record.get('tag_name') or "").lower()
+        if (genus.lower() not in botanical_value) and (genus.lower() not in tag_name_value):
+            continue
+        if cultivar and genus.lower() == 'camellia':
+            if (cultivar.lower() not in botanical_value) and (cultivar.lower() not in tag_name_value):
+                continue
+        if match_keys(extract_candidate_key(record, genus), file_key):
+            candidates.append(record)
+    return candidates
+
+def _file_inputs(png_dir, truth):
+    inputs = []
+    for path, record_id in truth.items():
+        genus, cultivar = get_genus_and_cultivar_from_path(png_dir, path)
+        inputs.append((path, genus, cultivar, record_id))
+    return inputs
+
+def run_benchmark(rows, work_dir, workers=1, seed=0, distinct_images=False, pairwise_limit=2000):
+    """Generate a catalog of `rows` records under work_dir and measure every stage."""
+    source_dir = os.path.join(work_dir, "source")
+    records = generate_catalog(rows, seed)
+    os.makedirs(source_dir, exist_ok=True)
+    write_catalog_db(os.path.join(source_dir, "database.sqlite"), records)
+    truth = write_png_tree(os.path.join(source_dir, "png"), records, distinct_images, seed)
+    inputs = _file_inputs(os.path.join(source_dir, "png"), truth)
+    db_records = load_db_records(os.path.join(source_dir, "database.sqlite"))
+    tag_names = {r['id']: r['tag_name'] for r in records}
+    results = []
+
+    keys = {}
+    def extract_keys():
+        for path, genus, cultivar, _ in inputs:
+            keys[path] = extract_file_key(os.path.basename(path), genus, cultivar)
+    results.append(measure("extract_file_key", extract_keys, len(inputs)))
+
+    # The pairwise scan is quadratic; measure it on a sample.
+    sample = inputs[:pairwise_limit]
+    def pairwise():
+        correct = 0
+        for path, genus, cultivar, record_id in sample:
+            matched = pairwise_candidates(keys[path], genus, cultivar, db_records)
+            correct += [r['id'] for r in matched] == [record_id]
+        return correct / len(sample) if sample else None
+    results.append(measure("match_keys (pairwise)", pairwise, len(sample)))
+
+    def indexed():
+        index = CandidateIndex(db_records)
+        correct = 0
+        for path, genus, cultivar, record_id in inputs:
+            matched = find_candidate_record(keys[path], genus, cultivar, index)
+            correct += [r['id'] for r in matched] == [record_id]
+        return correct / len(inputs) if inputs else None
+    results.append(measure("find_candidate_record", indexed, len(inputs)))
+
+    # The rename and insert stages change the tree, so each run gets a fresh copy.
+    run_dir = os.path.join(work_dir, "run")
+    png_dir = os.path.join(run_dir, "png")
+    db_path = os.path.join(run_dir, "database.sqlite")
+    def fresh_copy():
+        shutil.rmtree(run_dir, ignore_errors=True)
+        shutil.copytree(source_dir, run_dir)
+
+    def rename():
+        index = CandidateIndex(db_records)
+        imagepipeline.process_directories([png_dir], png_dir, index, log=_quiet, workers=workers)
+        correct = 0
+        for path, _, _, record_id in inputs:
+            run_path = os.path.join(png_dir, os.path.relpath(path, source_dir + os.sep + "png"))
+            expected = os.path.join(os.path.dirname(run_path), f"{record_id}[{tag_names[record_id]}].png")
+            correct += os.path.exists(expected)
+        return correct / len(inputs) if inputs else None
+    results.append(measure("rename", rename, len(inputs), setup=fresh_copy))
+
+    def renamed_copy():
+        fresh_copy()
+        imagepipeline.process_directories([png_dir], png_dir, CandidateIndex(db_records),
+                                          log=_quiet, workers=workers)
+        if distinct_images:
+            write_near_duplicates(png_dir)
+    renamed_copy()
+    renamed = len(imagepipeline.collect_insertable_files(png_dir))
+    def insert():
+        imagepipeline.process_images_insertion(
+            png_dir, png_dir.rstrip(os.sep) + ".complete", db_path, log=_quiet,
+            derivatives=distinct_images, dedupe='skip' if distinct_images else None,
+            workers=workers)
+    results.append(measure("insert", insert, renamed, setup=renamed_copy))
+
+    for result in results:
+        result['rows'] = rows
+    return results
+
+def _quiet(message):
+    pass
+
+def format_results(results):
+    lines = [f"{'rows':>8}  {'stage':<24}{'files':>8}{'seconds':>10}{'files/sec':>12}"
+             f"{'peak MB':>9}{'accuracy':>10}"]
+    for r in results:
+        accuracy = "" if r['accuracy'] is None else f"{r['accuracy']:.1%}"
+        rate = "" if r['files_per_sec'] is None else f"{r['files_per_sec']:.1f}"
+        lines.append(f"{r['rows']:>8}  {r['stage']:<24}{r['files']:>8}{r['seconds']:>10.3f}"
+                     f"{rate:>12}{r['peak_mb']:>9.2f}{accuracy:>10}")
+    return "\n".join(lines)
+
+# -------------------------------------------------------------------
+# 3. Command Line
+# -------------------------------------------------------------------
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the image matching pipeline on synthetic data.")
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000],
+                        help="catalog sizes to generate (one benchmark per size)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="processes for the rename/insert stages (0 = one per CPU)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--distinct-images", action="store_true",
+                        help="write distinct 1280x960 images plus near-duplicate copies "
+                             "(enables dedupe/variants in the insert stage)")
+    parser.add_argument("--pairwise-limit", type=int, default=2000,
+                        help="files sampled for the quadratic pairwise stage")
+    parser.add_argument("--keep", default=None,
+                        help="directory to generate data in and keep (default: a temp dir)")
+    parser.add_argument("--json", default=None, help="also write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    all_results = []
+    for rows in args.rows:
+        work_dir = os.path.join(args.keep, str(rows)) if args.keep else tempfile.mkdtemp(prefix="imgbench-")
+        os.makedirs(work_dir, exist_ok=True)
+        try:
+            all_results.extend(run_benchmark(rows, work_dir, imagepipeline.resolve_workers(args.workers),
+                                             args.seed, args.distinct_images, args.pairwise_limit))
+        finally:
+            if not args.keep:
+                shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(format_results(all_results))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(all_results, f, indent=2)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
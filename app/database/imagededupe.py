@@ -0,0 +1,178 @@
+"""
+Perceptual-hash duplicate detection for CatalogImages.
+
+Vendors send the same photo under several names. Before an image is
+inserted, its difference hash (dHash) is compared with the hashes of the
+images already stored for the same plant; near-duplicates are skipped or
+flagged. Hashes are kept in CatalogImageHashes so later runs never decode
+an already-inserted image again.
+"""
+
+import os
+
+from PIL import Image
+
+HASH_SIZE = 8
+# Maximum number of differing bits (out of 64) for two images to count as duplicates.
+DEFAULT_MAX_DISTANCE = 6
+
+def dhash(image_path, hash_size=HASH_SIZE):
+    """
+    Return the 64-bit difference hash of an image as an int.
+    The image is converted to greyscale (reduce() does not handle every mode,
+    e.g. palette images) and shrunk with a cheap integer reduce() before the
+    final resize, so the cost is dominated by decoding, not resampling.
+    """
+    with Image.open(image_path) as img:
+        img.draft('L', (hash_size * 16, hash_size * 16))  # only JPEG honours this
+        img = img.convert('L')
+        factor = min(img.width // (hash_size * 8), img.height // (hash_size * 8))
+        if factor > 1:
+            img = img.reduce(factor)
+        small = img.resize((hash_size + 1, hash_size), Image.BILINEAR)
+    pixels = small.tobytes()
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+def safe_dhash(image_path):
+    """dhash() for pool workers: returns (image_path, hash or None, error)."""
+    try:
+        return image_path, dhash(image_path), None
+    except Exception as e:
+        return image_path, None, str(e)
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+def hash_to_text(value):
+    return f"{value:016x}"
+
+# -------------------------------------------------------------------
+# Database
+# -------------------------------------------------------------------
+def ensure_hash_table(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS CatalogImageHashes (
+            catalog_image_id INTEGER PRIMARY KEY REFERENCES CatalogImages (id) ON DELETE CASCADE,
+            dhash TEXT NOT NULL,
+            duplicate_of INTEGER
+        )
+    """)
+    conn.commit()
+
+class DuplicateDetector:
+    """
+    Per-plant perceptual-hash index used by the insertion pipeline.
+
+    Hashes of a plant's existing images are loaded the first time that plant
+    is seen; existing images that were inserted before hashing existed are
+    hashed once and stored. Files checked in this run are compared with each
+    other as well; each one is pending until record() (it was inserted) or
+    discard() (it was not) is called for it.
+    """
+
+    def __init__(self, conn, max_distance=DEFAULT_MAX_DISTANCE, log=print):
+        self.conn = conn
+        self.max_distance = max_distance
+        self.log = log
+        self._by_plant = {}  # plant id -> [(hash, CatalogImages id)]
+        self._pending = {}   # file path -> (plant id, hash), checked but not yet recorded
+        self._ids = {}       # file path -> CatalogImages id, for files recorded in this run
+        ensure_hash_table(conn)
+
+    def _load_plants(self, plant_ids, mapper=map):
+        missing = [pid for pid in set(plant_ids) if pid not in self._by_plant]
+        if not missing:
+            return
+        unhashed = []
+        for pid in missing:
+            self._by_plant[pid] = []
+            rows = self.conn.execute(
+                "SELECT ci.id, ci.image_path, h.dhash FROM CatalogImages ci "
+                "LEFT JOIN CatalogImageHashes h ON h.catalog_image_id = ci.id "
+                "WHERE ci.plantcatalog_id = ?", (pid,))
+            for image_id, image_path, text in rows:
+                if text is not None:
+                    self._by_plant[pid].append((int(text, 16), image_id))
+                elif image_path and os.path.exists(image_path):
+                    unhashed.append((pid, image_id, image_path))
+        if not unhashed:
+            return
+        # Backfill older images once so later runs can compare without decoding them.
+        results = mapper(safe_dhash, [path for _, _, path in unhashed])
+        rows = []
+        for (pid, image_id, _), (path, value, error) in zip(unhashed, results):
+            if error:
+                self.log(f"Error hashing existing image {path}: {error}")
+                continue
+            self._by_plant[pid].append((value, image_id))
+            rows.append((image_id, hash_to_text(value)))
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO CatalogImageHashes (catalog_image_id, dhash) VALUES (?, ?)", rows)
+
+    def check_batch(self, items, mapper=map):
+        """
+        Hash a batch of (file_path, plant_id) items and compare each one with
+        the plant's stored images and with earlier files of this run.
+        Returns {file_path: (hash or None, duplicate_ref or None)}, where
+        duplicate_ref is a CatalogImages id or the path of an earlier file.
+        """
+        self._load_plants([pid for _, pid in items], mapper)
+        hashes = {path: (value, error) for path, value, error
+                  in mapper(safe_dhash, [path for path, _ in items])}
+        checked = {}
+        for file_path, pid in items:
+            value, error = hashes[file_path]
+            if error:
+                self.log(f"Error hashing {file_path}: {error}")
+                checked[file_path] = (None, None)
+                continue
+            duplicate = None
+            for known, ref in self._by_plant[pid]:
+                if hamming(known, value) <= self.max_distance:
+                    duplicate = ref
+                    break
+            else:
+                for path, (other_pid, known) in self._pending.items():
+                    if other_pid == pid and hamming(known, value) <= self.max_distance:
+                        duplicate = path
+                        break
+            self._pending[file_path] = (pid, value)
+            checked[file_path] = (value, duplicate)
+        return checked
+
+    def discard(self, file_paths):
+        """Forget checked files that were not inserted."""
+        for file_path in file_paths:
+            self._pending.pop(file_path, None)
+
+    def record(self, entries):
+        """
+        Store hashes for newly inserted images and compare later files with
+        them: entries are (file_path, plantcatalog_id, image_path, hash,
+        duplicate_ref) with file_path as passed to check_batch and image_path
+        as stored in CatalogImages. A duplicate_ref that is the path of an
+        earlier file of this run is stored as that file's CatalogImages id.
+        """
+        rows = []
+        for file_path, plant_id, image_path, value, duplicate in entries:
+            self._pending.pop(file_path, None)
+            row = self.conn.execute(
+                "SELECT id FROM CatalogImages WHERE plantcatalog_id = ? AND image_path = ? "
+                "ORDER BY id LIMIT 1", (plant_id, image_path)).fetchone()
+            if row is None or value is None:
+                continue
+            self._ids[file_path] = row[0]
+            self._by_plant.setdefault(plant_id, []).append((value, row[0]))
+            if not isinstance(duplicate, int):
+                duplicate = self._ids.get(duplicate)
+            rows.append((row[0], hash_to_text(value), duplicate))
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO CatalogImageHashes (catalog_image_id, dhash, duplicate_of) "
+                "VALUES (?, ?, ?)", rows)
@@ -0,0 +1,113 @@
+"""
+Web-ready derivatives (resized WebP and JPEG copies) of catalog images.
+
+Each inserted image gets smaller variants written next to it, e.g.
+
+    png.complete/Anise/12[Anise Yellow].png
+    png.complete/Anise/12[Anise Yellow].w200.webp
+    png.complete/Anise/12[Anise Yellow].w200.jpg
+    ...
+
+and one CatalogImageVariants row per file, so the images API can serve a
+small variant instead of the multi-MB original.
+"""
+
+import os
+
+from PIL import Image
+
+DERIVATIVE_WIDTHS = (1200, 600, 200)
+DERIVATIVE_FORMATS = (
+    # (format name stored in the database, Pillow format, extension, save options)
+    ('webp', 'WEBP', '.webp', {'quality': 80, 'method': 4}),
+    ('jpeg', 'JPEG', '.jpg', {'quality': 82, 'optimize': True, 'progressive': True}),
+)
+
+def derivative_path(image_path, width, extension):
+    """Return the path of the width/format variant of image_path."""
+    stem, _ = os.path.splitext(image_path)
+    return f"{stem}.w{width}{extension}"
+
+def _flatten(img):
+    """Return an RGB copy of img, compositing any transparency onto white (for JPEG)."""
+    if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+        rgba = img.convert('RGBA')
+        background = Image.new('RGB', rgba.size, (255, 255, 255))
+        background.paste(rgba, mask=rgba.getchannel('A'))
+        return background
+    return img.convert('RGB')
+
+def make_derivatives(image_path, widths=DERIVATIVE_WIDTHS):
+    """
+    Write the resized variants of image_path and return a list of
+    (width, height, format, path, bytes) tuples.
+
+    Widths are produced largest first, each one resized from the previous
+    step rather than from the original. Widths at or above the original width
+    are skipped (images are never upscaled). Meant to run in a worker process.
+    """
+    variants = []
+    with Image.open(image_path) as original:
+        original.load()
+        current = original if original.mode in ('RGB', 'RGBA') else original.convert('RGBA')
+        for width in sorted(widths, reverse=True):
+            if width >= original.width:
+                continue
+            height = max(1, round(current.height * width / current.width))
+            current = current.resize((width, height), Image.LANCZOS)
+            for fmt, pil_format, extension, options in DERIVATIVE_FORMATS:
+                out_path = derivative_path(image_path, width, extension)
+                out_img = _flatten(current) if pil_format == 'JPEG' else current
+                out_img.save(out_path, pil_format, **options)
+                variants.append((width, height, fmt, out_path, os.path.getsize(out_path)))
+    return variants
+
+def safe_make_derivatives(image_path):
+    """make_derivatives() for pool workers: returns (image_path, variants, error)."""
+    try:
+        return image_path, make_derivatives(image_path), None
+    except Exception as e:
+        return image_path, [], str(e)
+
+# -------------------------------------------------------------------
+# Database
+# -------------------------------------------------------------------
+def ensure_variant_table(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS CatalogImageVariants (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            catalog_image_id INTEGER NOT NULL REFERENCES CatalogImages (id) ON DELETE CASCADE,
+            width INTEGER NOT NULL,
+            height INTEGER NOT NULL,
+            format TEXT NOT NULL,
+            image_path TEXT NOT NULL,
+            bytes INTEGER,
+            UNIQUE (catalog_image_id, width, format)
+        )
+    """)
+    # The web app finds variants by the original's image_path alone.
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_catalogimages_image_path ON CatalogImages (image_path)")
+    conn.commit()
+
+def record_variants(conn, results):
+    """
+    Write variant rows for results of (plantcatalog_id, image_path, variants),
+    where image_path is the CatalogImages.image_path of the original.
+    Returns the number of variant rows written.
+    """
+    rows = []
+    for plant_id, image_path, variants in results:
+        row = conn.execute("SELECT id FROM CatalogImages WHERE plantcatalog_id = ? AND image_path = ? "
+                           "ORDER BY id LIMIT 1", (plant_id, image_path)).fetchone()
+        if row is None:
+            continue
+        rows.extend((row[0], width, height, fmt, path, size)
+                    for width, height, fmt, path, size in variants)
+    with conn:
+        conn.executemany(
+            "INSERT INTO CatalogImageVariants "
+            "(catalog_image_id, width, height, format, image_path, bytes) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (catalog_image_id, width, format) DO UPDATE SET "
+            "height = excluded.height, image_path = excluded.image_path, bytes = excluded.bytes",
+            rows)
+    return len(rows)
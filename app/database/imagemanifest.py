@@ -0,0 +1,174 @@
+"""
+Processed-file manifest for resumable image processor runs.
+
+Each handled file is recorded in a small SQLite sidecar database with its
+size, mtime and outcome. A later run of the same stage skips files whose
+size/mtime are unchanged and whose outcome is final for that stage, so an
+interrupted run only does the remaining delta.
+
+The same sidecar database holds the MatchCache, which remembers which
+catalog records each file key matched, per genus/cultivar partition.
+"""
+
+import hashlib
+import os
+import sqlite3
+import time
+
+# Outcomes that mean "nothing more to do" for each stage. Errors are retried.
+FINAL_OUTCOMES = {
+    'match': {'renamed', 'no_match', 'ambiguous', 'skipped'},
+    'insert': {'inserted', 'duplicate'},
+}
+
+def catalog_signature(db_records):
+    """
+    Return a short hash of the catalog fields used for matching, so match
+    outcomes recorded against an older catalog are not trusted.
+    """
+    digest = hashlib.sha1()
+    for record in sorted(db_records, key=lambda r: r.get('id') or 0):
+        digest.update(f"{record.get('id')}\x1f{record.get('tag_name')}\x1f"
+                      f"{record.get('botanical')}\x1e".encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+def file_state(path):
+    """Return (size, mtime_ns) for path, or None if it cannot be stat'ed."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+class ProcessedManifest:
+    """SQLite-backed record of which files each stage has already handled."""
+
+    def __init__(self, path, commit_every=200):
+        self.path = path
+        self.commit_every = commit_every
+        self._pending = 0
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS processed_files (
+                stage TEXT NOT NULL,
+                path TEXT NOT NULL,
+                size INTEGER,
+                mtime_ns INTEGER,
+                outcome TEXT NOT NULL,
+                catalog TEXT NOT NULL DEFAULT '',
+                updated REAL NOT NULL,
+                PRIMARY KEY (stage, path)
+            )
+        """)
+        self.conn.commit()
+
+    def filter_pending(self, stage, file_list, catalog=""):
+        """
+        Split file_list into (pending, unchanged). A file is unchanged when the
+        manifest has a final outcome for it with the same size, mtime and
+        catalog signature.
+        """
+        final = FINAL_OUTCOMES.get(stage, set())
+        known = {
+            path: (size, mtime_ns, outcome, row_catalog)
+            for path, size, mtime_ns, outcome, row_catalog in self.conn.execute(
+                "SELECT path, size, mtime_ns, outcome, catalog FROM processed_files WHERE stage = ?",
+                (stage,))
+        }
+        pending, unchanged = [], []
+        for path in file_list:
+            row = known.get(path)
+            if (row and row[2] in final and row[3] == catalog
+                    and file_state(path) == (row[0], row[1])):
+                unchanged.append(path)
+            else:
+                pending.append(path)
+        return pending, unchanged
+
+    def record(self, stage, path, outcome, catalog="", state=None):
+        """
+        Record the outcome for path. state is (size, mtime_ns); if omitted the
+        file is stat'ed now, so pass state for files that are about to move.
+        """
+        state = state or file_state(path) or (None, None)
+        self.conn.execute(
+            "INSERT OR REPLACE INTO processed_files "
+            "(stage, path, size, mtime_ns, outcome, catalog, updated) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (stage, path, state[0], state[1], outcome, catalog, time.time()))
+        self._pending += 1
+        if self._pending >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        self.conn.commit()
+        self._pending = 0
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+
+class MatchCache:
+    """
+    Persistent (file_key, genus, cultivar) -> matched record ids cache.
+
+    Each entry is stored with the signature of the catalog partition it was
+    matched against (CandidateIndex.partition_signature) and is only returned
+    while that signature is unchanged, so editing the PlantCatalog rows of one
+    genus only costs re-matching the files of that genus. Entries for a
+    partition are loaded in one query the first time it is looked up.
+
+    conn is normally the ProcessedManifest's connection, so both live in the
+    same sidecar database and share its transactions.
+    """
+
+    def __init__(self, conn, commit_every=200):
+        self.conn = conn
+        self.commit_every = commit_every
+        self._pending = 0
+        self._loaded = {}
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS match_cache (
+                file_key TEXT NOT NULL,
+                genus TEXT NOT NULL,
+                cultivar TEXT NOT NULL,
+                partition TEXT NOT NULL,
+                record_ids TEXT NOT NULL,
+                updated REAL NOT NULL,
+                PRIMARY KEY (file_key, genus, cultivar)
+            )
+        """)
+        self.conn.commit()
+
+    def _entries(self, genus, cultivar, partition):
+        part = (genus, cultivar or "", partition)
+        entries = self._loaded.get(part)
+        if entries is None:
+            entries = {
+                file_key: tuple(int(i) for i in record_ids.split(",") if i)
+                for file_key, record_ids in self.conn.execute(
+                    "SELECT file_key, record_ids FROM match_cache "
+                    "WHERE genus = ? AND cultivar = ? AND partition = ?", part)
+            }
+            self._loaded[part] = entries
+        return entries
+
+    def lookup(self, genus, cultivar, partition, file_key):
+        """Return the cached record ids for file_key, or None if not cached for this partition."""
+        return self._entries(genus, cultivar, partition).get(file_key)
+
+    def store(self, genus, cultivar, partition, file_key, record_ids):
+        record_ids = tuple(record_ids)
+        self._entries(genus, cultivar, partition)[file_key] = record_ids
+        self.conn.execute(
+            "INSERT OR REPLACE INTO match_cache "
+            "(file_key, genus, cultivar, partition, record_ids, updated) VALUES (?, ?, ?, ?, ?, ?)",
+            (file_key, genus, cultivar or "", partition,
+             ",".join(str(i) for i in record_ids), time.time()))
+        self._pending += 1
+        if self._pending >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        self.conn.commit()
+        self._pending = 0
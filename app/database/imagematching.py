@@ -0,0 +1,484 @@
+"""
+Filename normalization and catalog matching for the plant image processor.
+
+This module has no GUI dependencies so it can be shared by the Tk
+application (imageprocessor.py) and the headless batch runner
+(imagepipeline.py).
+"""
+
+import hashlib
+import os
+import re
+import sqlite3
+import sys
+from bisect import bisect_left, bisect_right
+from collections import Counter, OrderedDict
+from difflib import SequenceMatcher
+
+# -------------------------------------------------------------------
+# 1. Sanitize Filename: Remove characters that are invalid in Windows
+# -------------------------------------------------------------------
+def sanitize_filename(filename):
+    # Remove any of these characters: <>:"/\|?*
+    return re.sub(r'[<>:"/\\|?*]', '', filename)
+
+# -------------------------------------------------------------------
+# 2. Normalization & Key Extraction Functions
+# -------------------------------------------------------------------
+def normalize(s):
+    """Lowercase and remove all non-alphanumeric characters."""
+    return re.sub(r'\W+', '', s).lower()
+
+def extract_candidate_key(record, genus):
+    """
+    Given a database record and the folder's genus, produce a candidate key
+    from the record's tag_name.
+    
+    Strategy:
+      - If tag_name contains parenthesized text, use that.
+      - Otherwise, remove the given genus (case-insensitively) from tag_name.
+      - If that leaves an empty string, revert to using the full tag_name.
+      - Also, if the botanical field contains extra info (after an "x"),
+        combine that.
+    """
+    tag = record.get('tag_name') or ""
+    botanical = record.get('botanical') or ""
+    
+    # (1) Use text in parentheses if available.
+    paren_match = re.search(r'\((.*?)\)', tag)
+    if (paren_match):
+        key = paren_match.group(1)
+    else:
+        # Remove the folder's genus from the tag name.
+        key = re.sub(genus, '', tag, flags=re.IGNORECASE)
+        if not key.strip():
+            # Fallback: if the removal empties the string, use the full tag.
+            key = tag
+    key = normalize(key)
+    
+    # (2) Check for extra info in botanical (e.g., "Illicium x floridanum").
+    parts = botanical.lower().split('x')
+    extra_key = ""
+    if len(parts) > 1:
+        extra = parts[1].strip()
+        extra = re.sub(r"[\'\"]", "", extra)
+        extra_key = normalize(extra)
+    
+    if extra_key:
+        if extra_key not in key:
+            key = key + extra_key
+        else:
+            key = extra_key
+    return key
+
+class CandidateKeyCache:
+    """
+    Bounded LRU cache for extract_candidate_key results, keyed by
+    (record id, genus).
+
+    Each entry remembers the tag_name/botanical values it was computed from;
+    if a record's fields change, the stale key is recomputed on the next
+    lookup. Once the cache is full, the least recently used entry is evicted.
+    """
+
+    def __init__(self, max_size=50000):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, record, genus):
+        """Return the candidate key for record/genus, computing it if needed."""
+        tag = record.get('tag_name')
+        botanical = record.get('botanical')
+        cache_key = (record.get('id'), genus)
+        entry = self._entries.get(cache_key)
+        if entry is not None and entry[0] == tag and entry[1] == botanical:
+            self._entries.move_to_end(cache_key)
+            self.hits += 1
+            return entry[2]
+
+        self.misses += 1
+        key = extract_candidate_key(record, genus)
+        self._entries[cache_key] = (tag, botanical, key)
+        self._entries.move_to_end(cache_key)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        return key
+
+    def invalidate(self, record_id=None):
+        """Drop cached keys for one record id, or everything if no id is given."""
+        if record_id is None:
+            self._entries.clear()
+            return
+        for cache_key in [k for k in self._entries if k[0] == record_id]:
+            del self._entries[cache_key]
+
+def extract_file_key(filename, genus, cultivar=None):
+    """
+    Given a filename (e.g., "anisebanapp.png"), remove the extension and the
+    genus (and cultivar, if applicable), then normalize the result.
+    """
+    name, _ = os.path.splitext(filename)
+    key = normalize(name)
+    genus_norm = normalize(genus)
+    if key.startswith(genus_norm):
+        key = key[len(genus_norm):]
+    if cultivar:
+        cultivar_norm = normalize(cultivar)
+        if key.startswith(cultivar_norm):
+            key = key[len(cultivar_norm):]
+    return key
+
+def get_genus_and_cultivar_from_path(base_dir, file_path):
+    """
+    From the file's full path, derive the folder (genus) and, if present, the cultivar.
+    For example:
+       - .../png/Anise/aniseyellow.png   -> ("Anise", None)
+       - .../png/Camellia/Japonica/xxxx.png -> ("Camellia", "Japonica")
+    """
+    rel_path = os.path.relpath(file_path, base_dir)
+    parts = rel_path.split(os.sep)
+    if len(parts) == 2:
+        return parts[0], None
+    elif len(parts) >= 3:
+        return parts[0], parts[1]
+    else:
+        return None, None
+
+# -------------------------------------------------------------------
+# 3. Matching Helpers
+# -------------------------------------------------------------------
+# Bump when a change to key extraction or matching can change results, so
+# persisted match results (see imagemanifest.MatchCache) are not reused.
+MATCHER_VERSION = 1
+
+def similar(a, b):
+    """Return a similarity ratio between two strings."""
+    return SequenceMatcher(None, a, b).ratio()
+
+def match_keys(candidate_key, file_key, threshold=0.7):
+    """
+    First try fuzzy matching. If the similarity ratio is above the threshold,
+    or if the sorted lists of words match, consider it a match.
+    """
+    if similar(candidate_key, file_key) >= threshold:
+        return True
+    # Fallback: split into words and compare sorted lists.
+    candidate_words = sorted(re.findall(r'[a-z]+', candidate_key))
+    file_words = sorted(re.findall(r'[a-z]+', file_key))
+    if candidate_words == file_words and candidate_words:
+        return True
+    return False
+
+def key_words(key):
+    """Return the sorted alphabetic words of a key (used by the word fallback)."""
+    return tuple(sorted(re.findall(r'[a-z]+', key)))
+
+class KeyMatcher:
+    """
+    Indexed version of match_keys for matching one file key against many
+    candidate keys.
+
+    Candidate keys are indexed by length, by their character (1-gram) profile
+    and by their sorted words. For a given file key only candidates whose
+    length could still reach the threshold are looked at; of those, any whose
+    shared-character count caps the ratio below the threshold are dropped
+    without running SequenceMatcher. The survivors are scored with the same
+    SequenceMatcher ratio as similar(), so accept/reject decisions are exactly
+    those of match_keys.
+
+    Rules:
+      - threshold: minimum SequenceMatcher ratio (same default as match_keys).
+      - word_fallback: also accept candidates whose sorted words equal the
+        file key's sorted words.
+    """
+
+    def __init__(self, items, threshold=0.7, word_fallback=True):
+        self.threshold = threshold
+        self.word_fallback = word_fallback
+        self.keys = []
+        self.payloads = []
+        self._profiles = []
+        self._by_words = {}
+        for key, payload in items:
+            pos = len(self.keys)
+            self.keys.append(key)
+            self.payloads.append(payload)
+            self._profiles.append(dict(Counter(key)))
+            words = key_words(key)
+            if words:
+                self._by_words.setdefault(words, []).append(pos)
+        self._by_length = sorted(range(len(self.keys)), key=lambda i: len(self.keys[i]))
+        self._lengths = [len(self.keys[i]) for i in self._by_length]
+        self._matcher = SequenceMatcher(None)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _length_window(self, file_len):
+        """Positions of candidates whose length allows ratio >= threshold."""
+        t = self.threshold
+        if t <= 0:
+            return self._by_length
+        if t > 1:
+            return []
+        # 2*min(a, b) / (a + b) >= t  <=>  b*t/(2-t) <= a <= b*(2-t)/t.
+        # Widen by one on each side; the exact check happens in match().
+        lo = bisect_left(self._lengths, int(file_len * t / (2 - t)) - 1)
+        hi = bisect_right(self._lengths, int(file_len * (2 - t) / t) + 1)
+        return self._by_length[lo:hi]
+
+    def match(self, file_key, top_k=None):
+        """
+        Return [(score, payload), ...] for every accepted candidate, best score
+        first (ties keep index order). If top_k is given, only the best top_k
+        are returned.
+        """
+        threshold = self.threshold
+        file_len = len(file_key)
+        file_profile = dict(Counter(file_key))
+        sm = self._matcher
+        sm.set_seq2(file_key)
+
+        accepted = {}
+        for pos in self._length_window(file_len):
+            key = self.keys[pos]
+            total = len(key) + file_len
+            if total == 0:
+                accepted[pos] = 1.0
+                continue
+            if 2.0 * min(len(key), file_len) / total < threshold:
+                continue
+            # Characters in common (multiset intersection) without building a Counter.
+            shared = 0
+            for ch, n in self._profiles[pos].items():
+                m = file_profile.get(ch)
+                if m:
+                    shared += n if n < m else m
+            if 2.0 * shared / total < threshold:
+                continue
+            sm.set_seq1(key)
+            score = sm.ratio()
+            if score >= threshold:
+                accepted[pos] = score
+
+        if self.word_fallback:
+            words = key_words(file_key)
+            for pos in self._by_words.get(words, ()) if words else ():
+                if pos not in accepted:
+                    sm.set_seq1(self.keys[pos])
+                    accepted[pos] = sm.ratio()
+
+        ranked = sorted(accepted.items(), key=lambda item: (-item[1], item[0]))
+        if top_k is not None:
+            ranked = ranked[:top_k]
+        return [(score, self.payloads[pos]) for pos, score in ranked]
+
+def _search_text(record):
+    # "botanical\x1ftag_name", lowercased: a folder name can only match
+    # inside one of the two fields, never across the separator.
+    return f"{record.get('botanical') or ''}\x1f{record.get('tag_name') or ''}".lower()
+
+class CandidateIndex:
+    """
+    Genus-partitioned view over the database records.
+
+    The lowercased botanical and tag_name of each record are kept as one
+    search string in a column next to the record list. The records
+    for a given genus (and, for Camellia-style folders, genus + cultivar) are
+    collected the first time that genus is looked up and reused for every
+    later file in the same folder, so a lookup only touches that genus's rows
+    instead of the whole catalog. Candidate keys are memoized in a
+    CandidateKeyCache shared by all lookups on the index, and each partition
+    gets a KeyMatcher over its candidate keys.
+
+    Call invalidate() after changing records that the index was built from.
+    """
+
+    def __init__(self, db_records, key_cache=None):
+        self.key_cache = key_cache if key_cache is not None else CandidateKeyCache()
+        self.records = list(db_records)
+        self._search = [_search_text(record) for record in self.records]
+        self._by_genus = {}
+        self._by_cultivar = {}
+        self._matchers = {}
+        self._signatures = {}
+        self._by_id = None
+        self._blob = None
+        self._starts = None
+
+    def __len__(self):
+        return len(self.records)
+
+    def _genus_positions(self, genus_lower):
+        positions = self._by_genus.get(genus_lower)
+        if positions is None:
+            # Same rule as before: the folder name must appear in either field.
+            # Search all rows at once with str.find over the joined column and
+            # map each hit back to its row.
+            if self._blob is None:
+                self._blob = "\n".join(self._search)
+                self._starts = []
+                offset = 0
+                for text in self._search:
+                    self._starts.append(offset)
+                    offset += len(text) + 1
+            positions = []
+            blob, starts, needle = self._blob, self._starts, genus_lower
+            i = blob.find(needle)
+            while i != -1:
+                pos = bisect_right(starts, i) - 1
+                row_end = starts[pos] + len(self._search[pos])
+                if i + len(needle) <= row_end:
+                    positions.append(pos)
+                    i = blob.find(needle, row_end + 1)
+                else:
+                    i = blob.find(needle, i + 1)
+            self._by_genus[genus_lower] = positions
+        return positions
+
+    def records_for(self, genus, cultivar=None):
+        """Return the records that are candidates for files in genus/cultivar."""
+        genus_lower = genus.lower()
+        if not (cultivar and genus_lower == 'camellia'):
+            key = (genus_lower, None)
+        else:
+            key = (genus_lower, cultivar.lower())
+        records = self._by_cultivar.get(key)
+        if records is None:
+            positions = self._genus_positions(genus_lower)
+            cultivar_lower = key[1]
+            if cultivar_lower is not None:
+                positions = [pos for pos in positions if cultivar_lower in self._search[pos]]
+            records = [self.records[pos] for pos in positions]
+            self._by_cultivar[key] = records
+        return records
+
+    def matcher_for(self, genus, cultivar=None, threshold=0.7):
+        """Return a KeyMatcher whose payloads are positions in records_for()."""
+        key = (genus.lower(), (cultivar or "").lower(), threshold)
+        matcher = self._matchers.get(key)
+        if matcher is None:
+            records = self.records_for(genus, cultivar)
+            matcher = KeyMatcher(
+                ((self.key_cache.get(record, genus), pos) for pos, record in enumerate(records)),
+                threshold=threshold,
+            )
+            self._matchers[key] = matcher
+        return matcher
+
+    def partition_signature(self, genus, cultivar=None, threshold=0.7):
+        """
+        Return a short hash of the records_for(genus, cultivar) rows (and the
+        matching rules), which changes whenever a match against that
+        partition could come out differently.
+        """
+        key = (genus.lower(), (cultivar or "").lower(), threshold)
+        signature = self._signatures.get(key)
+        if signature is None:
+            digest = hashlib.sha1(f"{MATCHER_VERSION}\x1f{genus}\x1f{cultivar or ''}\x1f{threshold}\x1e"
+                                  .encode('utf-8'))
+            for record in self.records_for(genus, cultivar):
+                digest.update(f"{record.get('id')}\x1f{record.get('tag_name')}\x1f"
+                              f"{record.get('botanical')}\x1e".encode('utf-8'))
+            signature = self._signatures[key] = digest.hexdigest()[:16]
+        return signature
+
+    def records_by_id(self, record_ids):
+        """Return the records with the given ids, or None if any id is not in the catalog."""
+        if self._by_id is None:
+            self._by_id = {record.get('id'): record for record in self.records}
+        try:
+            return [self._by_id[record_id] for record_id in record_ids]
+        except KeyError:
+            return None
+
+    def invalidate(self, record_id=None):
+        """
+        Re-read the search text of the records and forget partitions and
+        matchers (and cached keys for record_id, or all).
+        """
+        self._search = [_search_text(record) for record in self.records]
+        self._blob = None
+        self._starts = None
+        self._by_genus.clear()
+        self._by_cultivar.clear()
+        self._matchers.clear()
+        self._signatures.clear()
+        self._by_id = None
+        self.key_cache.invalidate(record_id)
+
+def find_candidate_record(file_key, genus, cultivar, db_records, threshold=0.7):
+    """
+    From the database records, select those where the folder name (genus) appears
+    in either the botanical field or tag_name. Then, extract the candidate key and
+    use fuzzy matching (with fallback on sorted words) to see if it matches the file_key.
+
+    db_records may be a plain list of records or a prebuilt CandidateIndex; pass
+    an index when matching many files so the genus filtering is done only once.
+    """
+    index = db_records if isinstance(db_records, CandidateIndex) else CandidateIndex(db_records)
+    records = index.records_for(genus, cultivar)
+    matcher = index.matcher_for(genus, cultivar, threshold)
+    # Keep the catalog order of the matches, as the linear scan did.
+    positions = sorted(pos for _, pos in matcher.match(file_key))
+    return [records[pos] for pos in positions]
+
+
+
+
+# -------------------------------------------------------------------
+# 4. Catalog Records
+# -------------------------------------------------------------------
+class CatalogRecord:
+    """
+    One PlantCatalog row as used by the matcher.
+
+    Rows are slotted objects instead of dicts (about a third of the size),
+    and botanical names are interned since many cultivars share one.
+    record['id'] and record.get('tag_name') work as they did on dict rows.
+    """
+
+    __slots__ = ('id', 'tag_name', 'botanical')
+    FIELDS = __slots__
+
+    def __init__(self, id, tag_name, botanical):
+        self.id = id
+        self.tag_name = tag_name
+        self.botanical = sys.intern(botanical) if isinstance(botanical, str) else botanical
+
+    @classmethod
+    def from_mapping(cls, mapping):
+        return cls(mapping.get('id'), mapping.get('tag_name'), mapping.get('botanical'))
+
+    def __getitem__(self, key):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.FIELDS else default
+
+    def keys(self):
+        return self.FIELDS
+
+    def __repr__(self):
+        return repr({field: getattr(self, field) for field in self.FIELDS})
+
+def load_db_records(db_path):
+    """
+    Connect to the SQLite database and load all records from the table.
+    (Adjust the table name if needed; here it is assumed to be "PlantCatalog".)
+    Rows are read from the cursor one at a time into CatalogRecord objects,
+    so no intermediate list of row dicts is built.
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        cur = conn.execute("SELECT id, tag_name, botanical FROM PlantCatalog")
+        return [CatalogRecord(*row) for row in cur]
+    finally:
+        conn.close()
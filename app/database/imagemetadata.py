@@ -0,0 +1,89 @@
+"""
+Header-only metadata (dimensions, format, size, mtime) for catalog images.
+
+Image.open() only parses the file header; the pixels are never decoded, so
+reading the metadata of an image costs a stat and a few KB of I/O. Results
+are kept in CatalogImageMetadata, one row per CatalogImages row, so the web
+app can size placeholders and pick variants without touching the files.
+"""
+
+import os
+
+from PIL import Image
+
+def read_image_metadata(image_path):
+    """Return (width, height, format, bytes, mtime) for image_path without decoding it."""
+    st = os.stat(image_path)
+    with Image.open(image_path) as img:
+        width, height = img.size
+        fmt = (img.format or "").lower()
+    return width, height, fmt, st.st_size, st.st_mtime
+
+def safe_read_image_metadata(image_path):
+    """read_image_metadata() for worker threads: returns (image_path, metadata or None, error)."""
+    try:
+        return image_path, read_image_metadata(image_path), None
+    except Exception as e:
+        return image_path, None, str(e)
+
+# -------------------------------------------------------------------
+# Database
+# -------------------------------------------------------------------
+def ensure_metadata_table(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS CatalogImageMetadata (
+            catalog_image_id INTEGER PRIMARY KEY REFERENCES CatalogImages (id) ON DELETE CASCADE,
+            width INTEGER NOT NULL,
+            height INTEGER NOT NULL,
+            format TEXT NOT NULL,
+            bytes INTEGER NOT NULL,
+            mtime REAL NOT NULL
+        )
+    """)
+    conn.commit()
+
+def record_metadata(conn, results):
+    """
+    Write metadata rows for results of (catalog_image_id, metadata) pairs in
+    one transaction. Returns the number of rows written.
+    """
+    rows = [(image_id,) + tuple(metadata) for image_id, metadata in results]
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO CatalogImageMetadata "
+            "(catalog_image_id, width, height, format, bytes, mtime) VALUES (?, ?, ?, ?, ?, ?)",
+            rows)
+    return len(rows)
+
+def collect_image_metadata(conn, images, mapper=map, log=print):
+    """
+    Read and store the metadata of images, a list of (catalog_image_id,
+    file_path) pairs, using mapper (e.g. a thread pool's map) for the reads.
+    Returns the number of rows written.
+    """
+    ids = {}
+    for image_id, file_path in images:
+        ids.setdefault(file_path, []).append(image_id)
+    results = []
+    for file_path, metadata, error in mapper(safe_read_image_metadata, list(ids)):
+        if error:
+            log(f"Error reading metadata of {file_path}: {error}")
+            continue
+        results.extend((image_id, metadata) for image_id in ids[file_path])
+    return record_metadata(conn, results) if results else 0
+
+def image_ids_for_paths(conn, images):
+    """
+    Return (catalog_image_id, image_path) for the CatalogImages rows of
+    images, a list of (plantcatalog_id, image_path) pairs.
+    """
+    return [(image_id, path) for plant_id, path in images
+            for (image_id,) in conn.execute(
+                "SELECT id FROM CatalogImages WHERE plantcatalog_id = ? AND image_path = ?", (plant_id, path))]
+
+def images_missing_metadata(conn):
+    """Return (catalog_image_id, image_path) for CatalogImages rows without metadata."""
+    sql = ("SELECT ci.id, ci.image_path FROM CatalogImages ci "
+           "LEFT JOIN CatalogImageMetadata m ON m.catalog_image_id = ci.id "
+           "WHERE m.catalog_image_id IS NULL AND ci.image_path IS NOT NULL ORDER BY ci.id")
+    return conn.execute(sql).fetchall()
@@ -0,0 +1,152 @@
+"""
+Lightweight run instrumentation for the image processor pipelines.
+
+RunMetrics collects per-stage timers (count, total, min, max and a log2
+histogram of durations) and named counters. Recording a sample is a couple
+of dict lookups and additions, so metrics are always on. At the end of a run
+the metrics are written as JSON; while running they can optionally be
+streamed as JSON lines.
+"""
+
+import json
+import threading
+import time
+
+class StageTimer:
+    """Duration statistics for one stage."""
+
+    __slots__ = ('count', 'total', 'min', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = 0.0
+        # buckets[k] counts samples in [2**(k-1), 2**k) microseconds.
+        self.buckets = {}
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if seconds > self.max:
+            self.max = seconds
+        bucket = int(seconds * 1e6).bit_length()
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'total_seconds': round(self.total, 6),
+            'mean_ms': round(self.total / self.count * 1000, 4) if self.count else None,
+            'min_ms': round(self.min * 1000, 4) if self.min is not None else None,
+            'max_ms': round(self.max * 1000, 4),
+            'histogram_us': {f"<{2 ** k}": n for k, n in sorted(self.buckets.items())},
+        }
+
+    def merge(self, data):
+        """Add the samples of another timer's raw state (see RunMetrics.raw)."""
+        self.count += data['count']
+        self.total += data['total']
+        if data['min'] is not None and (self.min is None or data['min'] < self.min):
+            self.min = data['min']
+        self.max = max(self.max, data['max'])
+        for bucket, n in data['buckets'].items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + n
+
+class _Timing:
+    __slots__ = ('metrics', 'stage', 'started')
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.stage, time.perf_counter() - self.started)
+        return False
+
+class RunMetrics:
+    """
+    Stage timers and counters for one pipeline run.
+
+    stream, if given, is called with a JSON-serialisable snapshot at most once
+    every stream_interval seconds while the run is in progress. Timers and
+    counters may be updated from several threads.
+    """
+
+    def __init__(self, run, stream=None, stream_interval=5.0):
+        self.run = run
+        self.started = time.time()
+        self.timers = {}
+        self.counters = {}
+        self.stream = stream
+        self.stream_interval = stream_interval
+        self._last_stream = time.perf_counter()
+        self._lock = threading.RLock()
+
+    def time(self, stage):
+        """Context manager that records how long its block takes under stage."""
+        return _Timing(self, stage)
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            timer = self.timers.get(stage)
+            if timer is None:
+                timer = self.timers[stage] = StageTimer()
+            timer.add(seconds)
+            if self.stream is not None:
+                self._maybe_stream()
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def _maybe_stream(self):
+        now = time.perf_counter()
+        if now - self._last_stream >= self.stream_interval:
+            self._last_stream = now
+            self.stream(self.to_dict())
+
+    def raw(self):
+        """Picklable timer/counter state, for sending from pool workers."""
+        with self._lock:
+            return {
+                'timers': {stage: {'count': t.count, 'total': t.total, 'min': t.min,
+                                   'max': t.max, 'buckets': dict(t.buckets)}
+                           for stage, t in self.timers.items()},
+                'counters': dict(self.counters),
+            }
+
+    def merge(self, raw):
+        """Fold in the raw() state of another RunMetrics (e.g. from a worker)."""
+        with self._lock:
+            for stage, data in raw['timers'].items():
+                self.timers.setdefault(stage, StageTimer()).merge(data)
+            for name, n in raw['counters'].items():
+                self.count(name, n)
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'run': self.run,
+                'started': self.started,
+                'elapsed_seconds': round(time.time() - self.started, 3),
+                'stages': {stage: timer.to_dict() for stage, timer in self.timers.items()},
+                'counters': dict(sorted(self.counters.items())),
+            }
+
+    def write_json(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+def json_lines_stream(file):
+    """Return a RunMetrics stream callback that writes one JSON line per snapshot."""
+    def stream(snapshot):
+        file.write(json.dumps(snapshot) + "\n")
+        file.flush()
+    return stream
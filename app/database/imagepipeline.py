@@ -0,0 +1,919 @@
+#!/usr/bin/env python
+"""
+Headless rename and insert pipelines for the plant image processor.
+
+The Tk application (imageprocessor.py) drives these same functions, passing
+its own log/progress callbacks. They can also be run without a display, e.g.
+from cron on the server:
+
+    python app/database/imagepipeline.py match  --png-dir png --db database.sqlite [--workers 16]
+    python app/database/imagepipeline.py insert --png-dir png --db database.sqlite \
+        --complete-dir png.complete
+
+Both commands print a throughput summary when they finish. The watch command
+runs until interrupted, renaming and inserting photos as they are dropped
+into png/:
+
+    python app/database/imagepipeline.py watch --png-dir png --db database.sqlite
+
+Images inserted before image metadata was recorded can be backfilled with
+
+    python app/database/imagepipeline.py metadata --db database.sqlite
+"""
+
+import argparse
+import errno
+import os
+import queue
+import re
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from imagederivatives import ensure_variant_table, record_variants, safe_make_derivatives
+from imagededupe import DuplicateDetector
+from imagemetadata import (
+    collect_image_metadata,
+    ensure_metadata_table,
+    image_ids_for_paths,
+    images_missing_metadata,
+)
+from imagemanifest import MatchCache, ProcessedManifest, catalog_signature, file_state
+from imagemetrics import RunMetrics, json_lines_stream
+from imagewatch import FolderWatcher
+from imagematching import (
+    CandidateIndex,
+    extract_file_key,
+    find_candidate_record,
+    get_genus_and_cultivar_from_path,
+    load_db_records,
+    sanitize_filename,
+)
+
+# Renamed files look like "{id}[{tag_name}].png".
+INSERTABLE_PATTERN = re.compile(r'^(\d+)\[(.+?)\]\.png$', re.IGNORECASE)
+
+# -------------------------------------------------------------------
+# 1. File Discovery
+# -------------------------------------------------------------------
+def collect_png_files(directories):
+    """Collect all PNG files recursively from the given directories."""
+    file_list = []
+    for d in directories:
+        for root, _, files in os.walk(d):
+            for f in files:
+                if f.lower().endswith(".png"):
+                    file_list.append(os.path.join(root, f))
+    return file_list
+
+def collect_insertable_files(png_dir):
+    """Collect renamed "{id}[{tag_name}].png" files under png_dir."""
+    file_list = []
+    for root, _, files in os.walk(png_dir):
+        for f in files:
+            if INSERTABLE_PATTERN.match(f):
+                file_list.append(os.path.join(root, f))
+    return file_list
+
+# -------------------------------------------------------------------
+# 2. Run Statistics
+# -------------------------------------------------------------------
+def new_run_stats(stage, metrics=None):
+    """
+    Return an empty statistics dict for a pipeline run. stats['metrics'] is
+    the run's RunMetrics (stage timers and counters, see imagemetrics).
+    """
+    return {'stage': stage, 'files': 0, 'outcomes': {}, 'started': time.perf_counter(), 'seconds': 0.0,
+            'metrics': metrics if metrics is not None else RunMetrics(stage)}
+
+def count_outcome(stats, outcome):
+    stats['outcomes'][outcome] = stats['outcomes'].get(outcome, 0) + 1
+    stats['metrics'].count(f"outcome.{outcome}")
+
+def finish_run_stats(stats):
+    stats['seconds'] = time.perf_counter() - stats['started']
+    stats['metrics'].count("files", stats['files'])
+    return stats
+
+def format_summary(stats):
+    """Return a one-line throughput summary for a finished run."""
+    seconds = stats['seconds']
+    rate = stats['files'] / seconds if seconds > 0 else 0.0
+    outcomes = ", ".join(f"{name}={count}" for name, count in sorted(stats['outcomes'].items()))
+    summary = f"{stats['stage']}: {stats['files']} files in {seconds:.2f}s ({rate:.1f} files/sec)"
+    if stats.get('unchanged'):
+        summary += f", {stats['unchanged']} unchanged skipped"
+    if 'rows' in stats:
+        row_rate = stats['rows'] / seconds if seconds > 0 else 0.0
+        summary += f", {stats['rows']} rows ({row_rate:.1f} rows/sec)"
+    if 'variants' in stats:
+        summary += f", {stats['variants']} variants"
+    if stats.get('duplicates'):
+        summary += f", {stats['duplicates']} near-duplicates"
+    if 'metadata' in stats:
+        summary += f", {stats['metadata']} metadata rows"
+    return summary + ('; ' + outcomes if outcomes else '')
+
+# -------------------------------------------------------------------
+# 3. Matching (in-process or across a process pool)
+# -------------------------------------------------------------------
+# Catalog index for pool workers; set once per worker by _init_match_worker.
+_worker_index = None
+_worker_png_dir = None
+
+def match_file(file_path, png_dir, index, metrics):
+    """
+    Match one PNG against the catalog, timing the key extraction and
+    matching stages in metrics.
+    Returns (file_path, genus, file_key, candidates); genus is None if the
+    file is not inside a genus folder.
+    """
+    with metrics.time("extract_key"):
+        genus, cultivar = get_genus_and_cultivar_from_path(png_dir, file_path)
+        if not genus:
+            return file_path, None, None, []
+        file_key = extract_file_key(os.path.basename(file_path), genus, cultivar)
+    with metrics.time("match"):
+        candidates = find_candidate_record(file_key, genus, cultivar, index)
+    return file_path, genus, file_key, candidates
+
+def _init_match_worker(db_records, png_dir):
+    global _worker_index, _worker_png_dir
+    _worker_index = CandidateIndex(db_records)
+    _worker_png_dir = png_dir
+
+def _match_chunk(chunk):
+    metrics = RunMetrics("match-worker")
+    results = [match_file(file_path, _worker_png_dir, _worker_index, metrics) for file_path in chunk]
+    return results, metrics.raw()
+
+def iter_matches(file_list, png_dir, index, metrics, workers=1, chunk_size=256, match_cache=None):
+    """
+    Yield match_file() results for file_list, in file_list order.
+
+    With workers > 1 the files are matched in a ProcessPoolExecutor. The
+    catalog is sent to each worker once through the pool initializer, and
+    the files are sent in contiguous chunks (so a chunk usually stays inside
+    one genus folder and reuses that worker's partition). Worker stage
+    timings are merged into metrics as each chunk comes back.
+
+    With a MatchCache, only files without a cached result for their current
+    catalog partition are matched (see _iter_cached_matches).
+    """
+    if match_cache is not None:
+        yield from _iter_cached_matches(file_list, png_dir, index, metrics, workers,
+                                        chunk_size, match_cache)
+        return
+    if workers <= 1 or len(file_list) <= chunk_size:
+        for file_path in file_list:
+            yield match_file(file_path, png_dir, index, metrics)
+        return
+
+    chunks = [file_list[i:i + chunk_size] for i in range(0, len(file_list), chunk_size)]
+    db_records = index.records
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_match_worker,
+                             initargs=(db_records, png_dir)) as pool:
+        # map() returns results in submission order, keeping the run deterministic.
+        for results, worker_metrics in pool.map(_match_chunk, chunks):
+            metrics.merge(worker_metrics)
+            yield from results
+
+def _iter_cached_matches(file_list, png_dir, index, metrics, workers, chunk_size, match_cache):
+    """
+    iter_matches() through a MatchCache. File keys are extracted up front;
+    files whose (file_key, genus, cultivar) has a cached result for the
+    partition's current signature are answered from the cache, the rest are
+    matched by iter_matches() (in the pool if workers > 1) and stored.
+    """
+    planned = []
+    misses = []
+    with metrics.time("match_cache"):
+        for file_path in file_list:
+            genus, cultivar = get_genus_and_cultivar_from_path(png_dir, file_path)
+            if not genus:
+                planned.append((file_path, None, None, None, None, []))
+                continue
+            file_key = extract_file_key(os.path.basename(file_path), genus, cultivar)
+            signature = index.partition_signature(genus, cultivar)
+            record_ids = match_cache.lookup(genus, cultivar, signature, file_key)
+            candidates = index.records_by_id(record_ids) if record_ids is not None else None
+            if candidates is None:
+                misses.append(file_path)
+            planned.append((file_path, genus, cultivar, file_key, signature, candidates))
+    metrics.count("match_cache.miss", len(misses))
+    metrics.count("match_cache.hit", sum(1 for p in planned if p[1] and p[5] is not None))
+
+    matched = iter_matches(misses, png_dir, index, metrics, workers, chunk_size)
+    for file_path, genus, cultivar, file_key, signature, candidates in planned:
+        if candidates is None:
+            result = next(matched)
+            match_cache.store(genus, cultivar, signature, file_key,
+                              [record['id'] for record in result[3]])
+            yield result
+        else:
+            yield file_path, genus, file_key, candidates
+    match_cache.commit()
+
+def resolve_workers(workers):
+    """Turn a --workers value into a process count (0 means one per CPU)."""
+    if workers is None or workers < 0:
+        return 1
+    return workers or os.cpu_count() or 1
+
+# -------------------------------------------------------------------
+# 4. Rename Pipeline
+# -------------------------------------------------------------------
+def _noop(*args):
+    pass
+
+def process_directories(directories, png_dir, db_records, log=print, progress=None,
+                        on_renamed=None, throttle=0.0, workers=1, chunk_size=256,
+                        manifest=None, metrics=None, file_list=None, match_cache=None):
+    """
+    Traverse the given directories, match each PNG file to a db record, and
+    rename it to "{id}[{tag_name}].png".
+
+    db_records may be a list of records or a CandidateIndex. progress is called
+    as progress(done, total) and on_renamed(new_path) after each rename.
+    throttle is an optional per-file sleep (seconds) for UI pacing.
+    With workers > 1, matching runs in a process pool (see iter_matches);
+    renames always happen here, in file order.
+    If a ProcessedManifest is given, files it already handled (unchanged, and
+    against the same catalog) are skipped and every outcome is recorded.
+    Stage timings and outcome counters go to metrics (a RunMetrics; one is
+    created if not given) and are available as stats['metrics'].
+    If file_list is given, only those files are matched instead of walking
+    directories. With a MatchCache (see imagemanifest), files whose key was
+    already matched against an unchanged catalog partition are not matched
+    again.
+    Returns the run statistics.
+    """
+    progress = progress or _noop
+    on_renamed = on_renamed or _noop
+    index = db_records if isinstance(db_records, CandidateIndex) else CandidateIndex(db_records)
+    stats = new_run_stats("match", metrics)
+    metrics = stats['metrics']
+
+    if file_list is None:
+        with metrics.time("walk"):
+            file_list = collect_png_files(directories)
+        log(f"Found {len(file_list)} PNG files in selected directories.")
+    catalog = ""
+    if manifest is not None:
+        catalog = catalog_signature(index.records)
+        with metrics.time("manifest_filter"):
+            file_list, unchanged = manifest.filter_pending("match", file_list, catalog)
+        stats['unchanged'] = len(unchanged)
+        if unchanged:
+            log(f"Skipping {len(unchanged)} unchanged files already handled in an earlier run.")
+    total_files = len(file_list)
+
+    def record_outcome(path, outcome):
+        count_outcome(stats, outcome)
+        if manifest is not None:
+            manifest.record("match", path, outcome, catalog)
+
+    matches = iter_matches(file_list, png_dir, index, metrics, workers, chunk_size, match_cache)
+    for idx, (file_path, genus, file_key, candidates) in enumerate(matches, start=1):
+        stats['files'] += 1
+        if not genus:
+            log(f"Skipping file with no genus: {file_path}")
+            record_outcome(file_path, 'skipped')
+            continue
+
+        if len(candidates) == 1:
+            record = candidates[0]
+            # New filename format: {id}[{tag_name}].png
+            new_filename = f"{record['id']}[{record['tag_name']}].png"
+            new_full_path = os.path.join(os.path.dirname(file_path), new_filename)
+            try:
+                with metrics.time("rename"):
+                    os.rename(file_path, new_full_path)
+                log(f"Renamed:\n  {file_path}\n  -> {new_full_path}")
+                record_outcome(new_full_path, 'renamed')
+                on_renamed(new_full_path)
+            except Exception as e:
+                log(f"Error renaming {file_path}: {e}")
+                record_outcome(file_path, 'error')
+        elif len(candidates) == 0:
+            log(f"No match for file:\n  {file_path}\n  (file key: {file_key})")
+            record_outcome(file_path, 'no_match')
+        else:
+            log(f"Multiple matches for file:\n  {file_path}\n  (file key: {file_key})")
+            log(f"Candidates: {candidates}")
+            record_outcome(file_path, 'ambiguous')
+
+        progress(idx, total_files)
+        if throttle:
+            time.sleep(throttle)
+
+    if manifest is not None:
+        manifest.commit()
+    return finish_run_stats(stats)
+
+# -------------------------------------------------------------------
+# 5. Insert Pipeline
+# -------------------------------------------------------------------
+UPSERT_IMAGE_SQL = (
+    "INSERT INTO CatalogImages (plantcatalog_id, image_path) VALUES (?, ?) "
+    "ON CONFLICT (plantcatalog_id, image_path) DO NOTHING"
+)
+# Used when the unique index cannot be created (the table already holds duplicates).
+INSERT_IMAGE_IF_MISSING_SQL = (
+    "INSERT INTO CatalogImages (plantcatalog_id, image_path) "
+    "SELECT ?, ? WHERE NOT EXISTS "
+    "(SELECT 1 FROM CatalogImages WHERE plantcatalog_id = ? AND image_path = ?)"
+)
+
+def connect_db(db_path):
+    """
+    Open the catalog database for bulk writes.
+    WAL journaling lets the Next.js app keep reading while we write; it is a
+    persistent setting on the database file.
+    """
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+def ensure_image_unique_index(conn, log=print):
+    """
+    Create the unique (plantcatalog_id, image_path) index used by the upsert.
+    Returns False if existing duplicate rows prevent it.
+    """
+    try:
+        conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_catalogimages_plant_path "
+                     "ON CatalogImages (plantcatalog_id, image_path)")
+        conn.commit()
+        return True
+    except sqlite3.IntegrityError as e:
+        log(f"Could not add unique index on CatalogImages (existing duplicates?): {e}")
+        return False
+
+def insert_image_rows(conn, rows, unique_index=True):
+    """
+    Insert (plantcatalog_id, image_path) rows in a single transaction,
+    skipping rows that already exist. Returns the number of rows added.
+    """
+    before = conn.total_changes
+    with conn:
+        if unique_index:
+            conn.executemany(UPSERT_IMAGE_SQL, rows)
+        else:
+            conn.executemany(INSERT_IMAGE_IF_MISSING_SQL,
+                             [(pid, path, pid, path) for pid, path in rows])
+    return conn.total_changes - before
+
+def plan_image_move(file_path, png_dir, png_complete_dir):
+    """
+    Return (plant_id, new_path) for a renamed PNG, or None if the filename
+    does not look like "{id}[{tag_name}].png".
+    """
+    m = INSERTABLE_PATTERN.match(os.path.basename(file_path))
+    if not m:
+        return None
+    rel_path = os.path.relpath(file_path, png_dir)
+    new_path = os.path.join(png_complete_dir, rel_path)
+    base_name = sanitize_filename(os.path.basename(new_path))
+    return int(m.group(1)), os.path.join(os.path.dirname(new_path), base_name)
+
+def relocate_file(src, dst):
+    """
+    Move src to dst, creating dst's folder. On the same filesystem this is a
+    single rename. Across filesystems the file is copied to a temporary name
+    next to dst, renamed into place and only then removed from src, so dst
+    never exists half-written.
+    """
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    try:
+        os.replace(src, dst)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    part = dst + ".part"
+    try:
+        shutil.copyfile(src, part)
+        shutil.copystat(src, part)
+        os.replace(part, dst)
+    except BaseException:
+        if os.path.exists(part):
+            os.remove(part)
+        raise
+    os.remove(src)
+
+def _relocate(item):
+    """relocate_file() for the mover threads: returns (seconds, error or None)."""
+    file_path, _, new_path, _ = item
+    started = time.perf_counter()
+    try:
+        relocate_file(file_path, new_path)
+        error = None
+    except Exception as e:
+        error = e
+    return time.perf_counter() - started, error
+
+def _put(q, item, stop):
+    """Put item on a bounded queue, giving up once stop is set."""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+
+def _plan_batches(file_list, png_dir, png_complete_dir, batch_size, out, stop):
+    """
+    Planner thread: put lists of (file_path, plant_id, new_path, state) on
+    out, one per batch, followed by None. An exception is put on out instead.
+    """
+    try:
+        for start in range(0, len(file_list), batch_size):
+            batch = []
+            for file_path in file_list[start:start + batch_size]:
+                planned = plan_image_move(file_path, png_dir, png_complete_dir)
+                if planned:
+                    batch.append((file_path,) + planned + (file_state(file_path),))
+            _put(out, batch, stop)
+    except Exception as e:
+        _put(out, e, stop)
+    _put(out, None, stop)
+
+def generate_derivatives(conn, images, pool=None, log=print):
+    """
+    Write the web-ready variants of the given (already inserted) images, a
+    list of (plantcatalog_id, image_path), in the process pool if one is
+    given, and record them in CatalogImageVariants.
+    Returns the number of variant rows written.
+    """
+    mapper = pool.map if pool is not None else map
+    results = []
+    outputs = mapper(safe_make_derivatives, [image_path for _, image_path in images])
+    for (plant_id, _), (image_path, variants, error) in zip(images, outputs):
+        if error:
+            log(f"Error creating variants for {image_path}: {error}")
+        elif variants:
+            results.append((plant_id, image_path, variants))
+    return record_variants(conn, results) if results else 0
+
+def _finish_images(db_path, batches, derivatives, pool, reader_map, stats, metrics, log):
+    """
+    Finisher thread: for each list of moved (plantcatalog_id, image_path) on
+    batches, until None, store the images' metadata (read with reader_map)
+    and, with derivatives, their variants, through its own connection.
+    """
+    try:
+        conn = connect_db(db_path)
+    except Exception as e:
+        log(f"Error opening {db_path} for metadata and variants: {e}")
+        return
+    try:
+        while True:
+            moved = batches.get()
+            if moved is None:
+                return
+            try:
+                with metrics.time("metadata"):
+                    stats['metadata'] += collect_image_metadata(
+                        conn, image_ids_for_paths(conn, moved), reader_map, log)
+                if derivatives:
+                    with metrics.time("derivatives"):
+                        stats['variants'] += generate_derivatives(conn, moved, pool, log)
+            except Exception as e:
+                log(f"Error storing metadata and variants of a batch: {e}")
+    finally:
+        conn.close()
+
+def insertion_pool(workers, derivatives=True, dedupe='skip'):
+    """Return the process pool process_images_insertion uses, or None if it needs none."""
+    return ProcessPoolExecutor(max_workers=workers) if (derivatives or dedupe) and workers > 1 else None
+
+def process_images_insertion(png_dir, png_complete_dir, db_path, log=print, progress=None,
+                             on_inserted=None, throttle=0.0, batch_size=500, manifest=None,
+                             derivatives=True, workers=1, dedupe='skip', metrics=None,
+                             move_workers=4, queue_depth=2, file_list=None, pool=None):
+    """
+    Insert a CatalogImages row for every renamed PNG under png_dir and move the
+    file into png_complete_dir (keeping its relative folder).
+
+    Rows are written batch_size at a time with executemany in one transaction
+    per batch; rows that already exist are left alone, so re-runs do not
+    create duplicates. If a batch fails, its rows are retried one by one so
+    only the bad row is reported. Files are moved after their batch commits.
+
+    The run is pipelined: a planner thread prepares batches, this thread
+    writes them to the database, and move_workers threads relocate the files
+    of committed batches (see relocate_file) while the next batch is written.
+    At most queue_depth batches wait between each pair of stages. Batches are
+    finished (callbacks, manifest, hashes) in order; their moved images are
+    then handed to a finisher thread (see _finish_images) that stores their
+    metadata and variants while the following batches are inserted.
+
+    on_inserted(new_path) is called once the row is written and the file moved.
+    If a ProcessedManifest is given, files it already inserted (same path,
+    size and mtime) are skipped and every outcome is recorded.
+    With derivatives, each moved image also gets resized WebP/JPEG variants
+    (see imagederivatives), generated across `workers` processes.
+    dedupe ('skip', 'flag' or None) controls what happens to files whose
+    perceptual hash is close to an image already stored for the same plant
+    (see imagededupe): 'skip' leaves them in png_dir with a 'duplicate'
+    outcome, 'flag' inserts them but logs and records the duplicate.
+    The header metadata of every moved image (see imagemetadata) is read on
+    the mover threads and stored in CatalogImageMetadata.
+    Stage timings and outcome counters go to metrics (see process_directories).
+    If file_list is given, only those files are inserted instead of walking
+    png_dir. A ProcessPoolExecutor passed as pool is used instead of starting
+    one for the run, and is left running.
+    Returns the run statistics ('rows' is the number of new rows).
+    """
+    progress = progress or _noop
+    on_inserted = on_inserted or _noop
+    stats = new_run_stats("insert", metrics)
+    stats['rows'] = 0
+    metrics = stats['metrics']
+
+    if file_list is None:
+        with metrics.time("walk"):
+            file_list = collect_insertable_files(png_dir)
+        log(f"Found {len(file_list)} applicable PNG files for insertion.")
+    if manifest is not None:
+        with metrics.time("manifest_filter"):
+            file_list, unchanged = manifest.filter_pending("insert", file_list)
+        stats['unchanged'] = len(unchanged)
+        if unchanged:
+            log(f"Skipping {len(unchanged)} unchanged files already inserted in an earlier run.")
+    total_files = len(file_list)
+    if total_files == 0:
+        log("No applicable images found.")
+        return finish_run_stats(stats)
+
+    conn = connect_db(db_path)
+    unique_index = ensure_image_unique_index(conn, log)
+    ensure_metadata_table(conn)
+    stats['metadata'] = 0
+    if derivatives:
+        ensure_variant_table(conn)
+        stats['variants'] = 0
+    detector = DuplicateDetector(conn, log=log) if dedupe else None
+    if detector is not None:
+        stats['duplicates'] = 0
+    own_pool = pool is None
+    if own_pool:
+        pool = insertion_pool(workers, derivatives, dedupe)
+    mapper = pool.map if pool is not None else map
+    done = 0
+
+    def record_outcome(file_path, outcome, state=None):
+        nonlocal done
+        stats['files'] += 1
+        count_outcome(stats, outcome)
+        if manifest is not None:
+            manifest.record("insert", file_path, outcome, state=state)
+        done += 1
+        progress(done, total_files)
+
+    def finish_batch(written, moves, hashes):
+        moved = []
+        hashed = []
+        for item, move in zip(written, moves):
+            file_path, plant_id, new_path, state = item
+            with metrics.time("move_wait"):
+                seconds, error = move.result()
+            metrics.observe("move", seconds)
+            if error is None:
+                log(f"Inserted image record for plant id {plant_id}: {new_path}")
+                on_inserted(new_path)
+                moved.append((plant_id, new_path))
+                if file_path in hashes:
+                    hashed.append((file_path, plant_id, new_path) + hashes[file_path])
+                outcome = 'inserted'
+            else:
+                log(f"Error moving {file_path}: {error}")
+                outcome = 'error'
+            record_outcome(file_path, outcome, state)
+            if throttle:
+                time.sleep(throttle)
+
+        if hashes:
+            # Only inserted and moved files are compared with later ones.
+            with metrics.time("dedupe_record"):
+                detector.record(hashed)
+                detector.discard(set(hashes) - {entry[0] for entry in hashed})
+        if moved:
+            finishing.put(moved)
+
+    planned = queue.Queue(maxsize=max(1, queue_depth))
+    stop = threading.Event()
+    planner = threading.Thread(target=_plan_batches, daemon=True,
+                               args=(file_list, png_dir, png_complete_dir, batch_size, planned, stop))
+    movers = ThreadPoolExecutor(max_workers=max(1, move_workers), thread_name_prefix="relocate")
+    # Unbounded: it only holds paths, and inserting should not wait for variants.
+    finishing = queue.Queue()
+    finisher = threading.Thread(target=_finish_images, daemon=True,
+                                args=(db_path, finishing, derivatives, pool, movers.map,
+                                      stats, metrics, log))
+    in_flight = deque()
+    planner.start()
+    finisher.start()
+
+    try:
+        while True:
+            with metrics.time("plan_wait"):
+                batch = planned.get()
+            if batch is None:
+                break
+            if isinstance(batch, Exception):
+                raise batch
+
+            hashes = {}
+            if detector is not None:
+                with metrics.time("dedupe_hash"):
+                    hashes = detector.check_batch([(item[0], item[1]) for item in batch], mapper)
+                unique = []
+                for item in batch:
+                    file_path = item[0]
+                    duplicate = hashes[file_path][1]
+                    if duplicate is None:
+                        unique.append(item)
+                        continue
+                    stats['duplicates'] += 1
+                    ref = f"CatalogImages id {duplicate}" if isinstance(duplicate, int) else duplicate
+                    log(f"Near-duplicate of {ref} for plant id {item[1]}: {file_path}")
+                    if dedupe == 'flag':
+                        unique.append(item)
+                        continue
+                    detector.discard([file_path])
+                    record_outcome(file_path, 'duplicate')
+                batch = unique
+
+            try:
+                with metrics.time("db_insert"):
+                    stats['rows'] += insert_image_rows(
+                        conn, [(item[1], item[2]) for item in batch], unique_index)
+                written = batch
+            except sqlite3.Error as e:
+                log(f"Batch insert failed ({e}); retrying row by row.")
+                written = []
+                for item in batch:
+                    file_path, plant_id, new_path, _ = item
+                    try:
+                        stats['rows'] += insert_image_rows(conn, [(plant_id, new_path)], unique_index)
+                        written.append(item)
+                    except sqlite3.Error as row_error:
+                        log(f"Error inserting {file_path}: {row_error}")
+                        record_outcome(file_path, 'error')
+
+            in_flight.append((written, [movers.submit(_relocate, item) for item in written], hashes))
+            # Finish batches whose moves are done; block only when too many are in flight.
+            while in_flight and (len(in_flight) > queue_depth
+                                 or all(move.done() for move in in_flight[0][1])):
+                finish_batch(*in_flight.popleft())
+
+        while in_flight:
+            finish_batch(*in_flight.popleft())
+    finally:
+        # On an error, batches already committed (files moved or moving) still
+        # get their manifest, hash, metadata and variant rows.
+        while in_flight:
+            try:
+                finish_batch(*in_flight.popleft())
+            except Exception as e:
+                log(f"Error finishing a batch: {e}")
+        finishing.put(None)
+        finisher.join()
+        stop.set()
+        movers.shutdown(wait=True)
+        if own_pool and pool is not None:
+            pool.shutdown()
+        conn.close()
+        if manifest is not None:
+            manifest.commit()
+    return finish_run_stats(stats)
+
+def backfill_image_metadata(db_path, log=print, progress=None, threads=8, batch_size=500,
+                            metrics=None):
+    """
+    Record header metadata for CatalogImages rows that have none yet (images
+    inserted before metadata existed, or through the web app), reading the
+    headers on `threads` threads and writing one transaction per batch.
+    Rows whose file is missing on this machine are counted as 'missing'.
+    Returns the run statistics ('metadata' is the number of rows written).
+    """
+    progress = progress or _noop
+    stats = new_run_stats("metadata", metrics)
+    stats['metadata'] = 0
+    metrics = stats['metrics']
+
+    conn = connect_db(db_path)
+    ensure_metadata_table(conn)
+    with metrics.time("walk"):
+        images = images_missing_metadata(conn)
+    log(f"Found {len(images)} images without metadata.")
+    total = len(images)
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, threads)) as readers:
+            for start in range(0, total, batch_size):
+                batch = images[start:start + batch_size]
+                present = [(image_id, path) for image_id, path in batch if os.path.isfile(path)]
+                with metrics.time("metadata"):
+                    written = collect_image_metadata(conn, present, readers.map, log)
+                stats['metadata'] += written
+                stats['files'] += len(batch)
+                for _ in range(len(batch) - len(present)):
+                    count_outcome(stats, 'missing')
+                for _ in range(len(present) - written):
+                    count_outcome(stats, 'error')
+                for _ in range(written):
+                    count_outcome(stats, 'recorded')
+                progress(min(start + batch_size, total), total)
+    finally:
+        conn.close()
+    return finish_run_stats(stats)
+
+# -------------------------------------------------------------------
+# 6. Watch Mode
+# -------------------------------------------------------------------
+def watch_folder(png_dir, png_complete_dir, db_path, log=print, interval=2.0, settle=3.0,
+                 batch_size=50, manifest=None, derivatives=True, workers=1, move_workers=4,
+                 dedupe='skip', metrics=None, stop=None, on_cycle=None, catalog_refresh=60.0,
+                 match_cache=None):
+    """
+    Match and insert PNGs as they are dropped into png_dir, until stop (a
+    threading.Event) is set.
+
+    png_dir is polled every `interval` seconds with a FolderWatcher (see
+    imagewatch); files are processed once their size and mtime have been
+    stable for `settle` seconds, at most batch_size at a time. New files are
+    renamed with process_directories and the renamed files are inserted in
+    the same cycle; files already named "{id}[{tag_name}].png" go straight to
+    insertion. The catalog is reloaded at most every catalog_refresh seconds.
+
+    on_cycle(stats_list) is called after every cycle that processed files,
+    with the run statistics of that cycle's match/insert runs. A cycle that
+    fails is logged and its files are retried once they settle again. The
+    insertion process pool is shared by every cycle.
+    """
+    stop = stop or threading.Event()
+    on_cycle = on_cycle or _noop
+    watcher = FolderWatcher(png_dir, settle=settle)
+    index = None
+    loaded_at = 0.0
+    log(f"Watching {png_dir} every {interval:g}s (files settle after {settle:g}s).")
+    pool = insertion_pool(workers, derivatives, dedupe)
+
+    try:
+        while not stop.is_set():
+            ready = watcher.poll()
+            for start in range(0, len(ready), batch_size):
+                chunk = ready[start:start + batch_size]
+                to_match = [p for p in chunk if not INSERTABLE_PATTERN.match(os.path.basename(p))]
+                to_insert = [p for p in chunk if INSERTABLE_PATTERN.match(os.path.basename(p))]
+                renamed = []
+                cycle = []
+                try:
+                    if to_match:
+                        if index is None or time.monotonic() - loaded_at >= catalog_refresh:
+                            index = CandidateIndex(load_db_records(db_path))
+                            loaded_at = time.monotonic()
+                        cycle.append(process_directories([png_dir], png_dir, index, log=log,
+                                                         on_renamed=renamed.append, workers=workers,
+                                                         manifest=manifest, metrics=metrics,
+                                                         file_list=to_match, match_cache=match_cache))
+                        watcher.mark_handled(renamed)
+                        to_insert.extend(renamed)
+                    if to_insert:
+                        cycle.append(process_images_insertion(
+                            png_dir, png_complete_dir, db_path, log=log, batch_size=batch_size,
+                            manifest=manifest, derivatives=derivatives, workers=workers,
+                            move_workers=move_workers, dedupe=dedupe, metrics=metrics,
+                            file_list=to_insert, pool=pool))
+                    on_cycle(cycle)
+                except Exception as e:
+                    log(f"Error processing {len(chunk)} dropped file(s): {e}")
+                    watcher.forget(chunk + renamed)
+                    if isinstance(e, BrokenProcessPool) and pool is not None:
+                        pool.shutdown()
+                        pool = insertion_pool(workers, derivatives, dedupe)
+            stop.wait(interval)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+# -------------------------------------------------------------------
+# 7. Command Line
+# -------------------------------------------------------------------
+def default_manifest_path(db_path):
+    return os.path.join(os.path.dirname(os.path.abspath(db_path)), "imageprocessor-manifest.sqlite")
+
+def default_metrics_path(db_path):
+    return os.path.join(os.path.dirname(os.path.abspath(db_path)), "imageprocessor-metrics.json")
+
+def build_arg_parser():
+    base_dir = os.path.abspath(os.path.dirname(__file__))
+    parser = argparse.ArgumentParser(description="Headless plant image rename/insert pipeline.")
+    parser.add_argument("command", choices=["match", "insert", "watch", "metadata"],
+                        help="match: rename PNGs to {id}[{tag_name}].png; "
+                             "insert: add renamed PNGs to CatalogImages; "
+                             "watch: keep doing both for files dropped into --png-dir; "
+                             "metadata: record size/format of inserted images that have none yet")
+    parser.add_argument("--png-dir", default=os.path.join(base_dir, "png"),
+                        help="root of the genus/cultivar image folders")
+    parser.add_argument("--db", default=os.path.join(base_dir, "database.sqlite"),
+                        help="path to the SQLite database")
+    parser.add_argument("--complete-dir", default=None,
+                        help="destination for inserted images (default: <png-dir>.complete)")
+    parser.add_argument("--batch-size", type=int, default=500,
+                        help="insert, metadata: rows per transaction")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of matching / variant-generation processes (0 = one per CPU)")
+    parser.add_argument("--move-workers", type=int, default=4,
+                        help="insert: threads moving inserted files into --complete-dir")
+    parser.add_argument("--threads", type=int, default=8,
+                        help="metadata: threads reading image headers")
+    parser.add_argument("--dedupe", choices=["skip", "flag", "off"], default="skip",
+                        help="insert: what to do with near-duplicate images of the same plant")
+    parser.add_argument("--no-derivatives", action="store_true",
+                        help="insert: do not generate resized WebP/JPEG variants")
+    parser.add_argument("--manifest", default=None,
+                        help="processed-file manifest (default: imageprocessor-manifest.sqlite next to --db)")
+    parser.add_argument("--no-resume", action="store_true",
+                        help="do not use the manifest or match cache; process every file")
+    parser.add_argument("--metrics", default=None,
+                        help="JSON metrics file written at the end of the run "
+                             "(default: imageprocessor-metrics.json next to --db)")
+    parser.add_argument("--metrics-stream", action="store_true",
+                        help="also stream metrics snapshots to stderr as JSON lines while running")
+    parser.add_argument("--interval", type=float, default=2.0,
+                        help="watch: seconds between polls of --png-dir")
+    parser.add_argument("--settle", type=float, default=3.0,
+                        help="watch: seconds a file's size and mtime must stay unchanged before it is processed")
+    parser.add_argument("--quiet", action="store_true", help="only print the final summary")
+    return parser
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    png_dir = os.path.abspath(args.png_dir)
+    log = _noop if args.quiet else print
+    metrics = RunMetrics(args.command,
+                         stream=json_lines_stream(sys.stderr) if args.metrics_stream else None)
+    manifest = None
+    match_cache = None
+    if not args.no_resume:
+        manifest = ProcessedManifest(args.manifest or default_manifest_path(args.db))
+        match_cache = MatchCache(manifest.conn)
+
+    complete_dir = os.path.abspath(args.complete_dir or png_dir.rstrip(os.sep) + ".complete")
+    metrics_path = args.metrics or default_metrics_path(args.db)
+    dedupe = None if args.dedupe == "off" else args.dedupe
+
+    try:
+        if args.command == "match":
+            index = CandidateIndex(load_db_records(args.db))
+            stats = process_directories([png_dir], png_dir, index, log=log,
+                                        workers=resolve_workers(args.workers), manifest=manifest,
+                                        metrics=metrics, match_cache=match_cache)
+        elif args.command == "metadata":
+            stats = backfill_image_metadata(args.db, log=log, threads=args.threads,
+                                            batch_size=args.batch_size, metrics=metrics)
+        elif args.command == "insert":
+            os.makedirs(complete_dir, exist_ok=True)
+            stats = process_images_insertion(png_dir, complete_dir, args.db, log=log,
+                                             batch_size=args.batch_size, manifest=manifest,
+                                             derivatives=not args.no_derivatives,
+                                             workers=resolve_workers(args.workers),
+                                             move_workers=args.move_workers,
+                                             dedupe=dedupe, metrics=metrics)
+        else:
+            os.makedirs(complete_dir, exist_ok=True)
+
+            def on_cycle(cycle):
+                for run_stats in cycle:
+                    print(format_summary(run_stats))
+                metrics.write_json(metrics_path)
+
+            try:
+                watch_folder(png_dir, complete_dir, args.db, log=log, interval=args.interval,
+                             settle=args.settle, batch_size=min(args.batch_size, 50),
+                             manifest=manifest, derivatives=not args.no_derivatives,
+                             workers=resolve_workers(args.workers),
+                             move_workers=args.move_workers, dedupe=dedupe,
+                             metrics=metrics, on_cycle=on_cycle, match_cache=match_cache)
+            except KeyboardInterrupt:
+                pass
+            metrics.write_json(metrics_path)
+            return 0
+    finally:
+        if manifest is not None:
+            manifest.close()
+
+    metrics.write_json(metrics_path)
+    print(format_summary(stats))
+    return 1 if stats['outcomes'].get('error') else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
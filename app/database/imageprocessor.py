@@ -1,162 +1,87 @@
-import sqlite3
+import queue
 import threading
 import time
 import tkinter as tk
 from tkinter import ttk, messagebox
 from PIL import Image, ImageTk
 import os
-import re
-import shutil
-from difflib import SequenceMatcher
 
-# -------------------------------------------------------------------
-# 1. Sanitize Filename: Remove characters that are invalid in Windows
-# -------------------------------------------------------------------
-def sanitize_filename(filename):
-    # Remove any of these characters: <>:"/\|?*
-    return re.sub(r'[<>:"/\\|?*]', '', filename)
+from imagemanifest import MatchCache, ProcessedManifest
+from imagematching import CandidateIndex, load_db_records
+import imagepipeline
 
-# -------------------------------------------------------------------
-# 2. Normalization & Key Extraction Functions
-# -------------------------------------------------------------------
-def normalize(s):
-    """Lowercase and remove all non-alphanumeric characters."""
-    return re.sub(r'\W+', '', s).lower()
+# How often (ms) the Tk thread drains queued log/progress/preview events.
+UI_PUMP_INTERVAL_MS = 50
+# The log console keeps at most this many lines.
+LOG_MAX_LINES = 5000
+# Previews are decoded to fit this box, at most once per PREVIEW_INTERVAL_MS,
+# and cleared after PREVIEW_DISPLAY_MS.
+PREVIEW_SIZE = (300, 300)
+PREVIEW_INTERVAL_MS = 250
+PREVIEW_DISPLAY_MS = 500
+# Modes Image.reduce() handles; others (P, PA, 1, I;16) are converted first.
+REDUCE_MODES = ('L', 'LA', 'RGB', 'RGBA', 'RGBX', 'CMYK', 'YCbCr', 'I', 'F')
 
-def extract_candidate_key(record, genus):
+def load_preview(image_path, size=PREVIEW_SIZE):
     """
-    Given a database record and the folder's genus, produce a candidate key
-    from the record's tag_name.
-    
-    Strategy:
-      - If tag_name contains parenthesized text, use that.
-      - Otherwise, remove the given genus (case-insensitively) from tag_name.
-      - If that leaves an empty string, revert to using the full tag_name.
-      - Also, if the botanical field contains extra info (after an "x"),
-        combine that.
+    Return a thumbnail of image_path no larger than size, decoding as little
+    as possible: JPEGs are decoded at reduced scale via draft(), and other
+    formats are shrunk with an integer reduce() before the final thumbnail.
     """
-    tag = record.get('tag_name') or ""
-    botanical = record.get('botanical') or ""
-    
-    # (1) Use text in parentheses if available.
-    paren_match = re.search(r'\((.*?)\)', tag)
-    if (paren_match):
-        key = paren_match.group(1)
-    else:
-        # Remove the folder's genus from the tag name.
-        key = re.sub(genus, '', tag, flags=re.IGNORECASE)
-        if not key.strip():
-            # Fallback: if the removal empties the string, use the full tag.
-            key = tag
-    key = normalize(key)
-    
-    # (2) Check for extra info in botanical (e.g., "Illicium x floridanum").
-    parts = botanical.lower().split('x')
-    extra_key = ""
-    if len(parts) > 1:
-        extra = parts[1].strip()
-        extra = re.sub(r"[\'\"]", "", extra)
-        extra_key = normalize(extra)
-    
-    if extra_key:
-        if extra_key not in key:
-            key = key + extra_key
+    with Image.open(image_path) as img:
+        img.draft("RGB", size)
+        factor = min(img.width // size[0], img.height // size[1])
+        if factor > 1:
+            if img.mode not in REDUCE_MODES:
+                img = img.convert('RGBA' if img.mode in ('P', 'PA') else 'RGB')
+            preview = img.reduce(factor)
         else:
-            key = extra_key
-    return key
-
-def extract_file_key(filename, genus, cultivar=None):
-    """
-    Given a filename (e.g., "anisebanapp.png"), remove the extension and the
-    genus (and cultivar, if applicable), then normalize the result.
-    """
-    name, _ = os.path.splitext(filename)
-    key = normalize(name)
-    genus_norm = normalize(genus)
-    if key.startswith(genus_norm):
-        key = key[len(genus_norm):]
-    if cultivar:
-        cultivar_norm = normalize(cultivar)
-        if key.startswith(cultivar_norm):
-            key = key[len(cultivar_norm):]
-    return key
-
-def get_genus_and_cultivar_from_path(base_dir, file_path):
-    """
-    From the file's full path, derive the folder (genus) and, if present, the cultivar.
-    For example:
-       - .../png/Anise/aniseyellow.png   -> ("Anise", None)
-       - .../png/Camellia/Japonica/xxxx.png -> ("Camellia", "Japonica")
-    """
-    rel_path = os.path.relpath(file_path, base_dir)
-    parts = rel_path.split(os.sep)
-    if len(parts) == 2:
-        return parts[0], None
-    elif len(parts) >= 3:
-        return parts[0], parts[1]
-    else:
-        return None, None
-
-# -------------------------------------------------------------------
-# 3. Matching Helpers
-# -------------------------------------------------------------------
-def similar(a, b):
-    """Return a similarity ratio between two strings."""
-    return SequenceMatcher(None, a, b).ratio()
+            preview = img.copy()
+    preview.thumbnail(size)
+    return preview
 
-def match_keys(candidate_key, file_key, threshold=0.7):
-    """
-    First try fuzzy matching. If the similarity ratio is above the threshold,
-    or if the sorted lists of words match, consider it a match.
+class PreviewLoader:
     """
-    if similar(candidate_key, file_key) >= threshold:
-        return True
-    # Fallback: split into words and compare sorted lists.
-    candidate_words = sorted(re.findall(r'[a-z]+', candidate_key))
-    file_words = sorted(re.findall(r'[a-z]+', file_key))
-    if candidate_words == file_words and candidate_words:
-        return True
-    return False
+    Background preview decoder.
 
-def find_candidate_record(file_key, genus, cultivar, db_records, threshold=0.7):
+    Only the most recent request is kept: asking for a new preview while one
+    is pending replaces it, and a decoded preview that the UI has not picked
+    up yet is replaced by a newer one. Decodes are spaced at least
+    PREVIEW_INTERVAL_MS apart, so previews never slow down a batch.
     """
-    From the database records, select those where the folder name (genus) appears
-    in either the botanical field or tag_name. Then, extract the candidate key and
-    use fuzzy matching (with fallback on sorted words) to see if it matches the file_key.
-    """
-    candidates = []
-    for record in db_records:
-        botanical_value = (record.get('botanical') or "").lower()
-        tag_name_value = (record.get('tag_name') or "").lower()
-        # Require that the folder name appears in either field.
-        if (genus.lower() not in botanical_value) and (genus.lower() not in tag_name_value):
-            continue
-
-        # For Camellia (or similar cases) with cultivar folders, filter further.
-        if cultivar and genus.lower() == 'camellia':
-            if (cultivar.lower() not in botanical_value) and (cultivar.lower() not in tag_name_value):
-                continue
 
-        candidate_key = extract_candidate_key(record, genus)
-        if match_keys(candidate_key, file_key, threshold):
-            candidates.append(record)
-    return candidates
+    def __init__(self, log):
+        self.log = log
+        self._cond = threading.Condition()
+        self._pending = None
+        self._result = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
 
+    def request(self, image_path):
+        with self._cond:
+            self._pending = image_path
+            self._cond.notify()
 
+    def take_result(self):
+        """Return the latest decoded (image_path, PIL image), or None."""
+        with self._cond:
+            result, self._result = self._result, None
+        return result
 
-
-def load_db_records(db_path):
-    """
-    Connect to the SQLite database and load all records from the table.
-    (Adjust the table name if needed; here it is assumed to be "PlantCatalog".)
-    """
-    conn = sqlite3.connect(db_path)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-    cur.execute("SELECT id, tag_name, botanical FROM PlantCatalog")
-    records = [dict(row) for row in cur.fetchall()]
-    conn.close()
-    return records
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._pending is None:
+                    self._cond.wait()
+                image_path, self._pending = self._pending, None
+            try:
+                preview = load_preview(image_path)
+                with self._cond:
+                    self._result = (image_path, preview)
+            except Exception as e:
+                self.log(f"Error displaying image {image_path}: {e}")
+            time.sleep(PREVIEW_INTERVAL_MS / 1000)
 
 # =============================================================================
 # Tkinter Application
@@ -173,6 +98,8 @@ class Application(tk.Tk):
         self.base_dir = os.path.abspath(os.path.dirname(__file__))
         self.png_dir = os.path.join(self.base_dir, "png")
         self.db_path = os.path.join(self.base_dir, "database.sqlite")
+        # Records which files earlier runs already handled, so reruns only do the delta.
+        self.manifest_path = imagepipeline.default_manifest_path(self.db_path)
         
         # Add new directory for processed images
         self.png_complete_dir = os.path.join(self.base_dir, "png.complete")
@@ -180,9 +107,17 @@ class Application(tk.Tk):
         
         # Load DB records from SQLite.
         self.db_records = load_db_records(self.db_path)
+        self.candidate_index = CandidateIndex(self.db_records)
+        
+        # Worker threads never touch widgets; they queue events that the
+        # Tk thread drains (see _pump_ui_events).
+        self.ui_events = queue.Queue()
+        self.preview_loader = PreviewLoader(self.log)
+        self._preview_clear_id = None
         
         # Build the UI
         self.create_widgets()
+        self.after(UI_PUMP_INTERVAL_MS, self._pump_ui_events)
     
     def create_widgets(self):
         # Use a PanedWindow to split the UI into a side panel and main panel.
@@ -204,6 +139,9 @@ class Application(tk.Tk):
         # Treeview widget for directory listing.
         self.tree = ttk.Treeview(self.side_frame, selectmode="extended")
         self.tree.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        # Folders are listed lazily, when their node is first expanded.
+        self.tree.bind("<<TreeviewOpen>>", self.on_tree_open)
+        self._loaded_nodes = {}
         
         # Add a vertical scrollbar to the tree.
         tree_scroll = ttk.Scrollbar(self.side_frame, orient="vertical", command=self.tree.yview)
@@ -213,6 +151,9 @@ class Application(tk.Tk):
         # Populate the tree with directories from the png folder.
         self.populate_treeview()
         
+        refresh_button = ttk.Button(self.side_frame, text="Refresh", command=self.refresh_treeview)
+        refresh_button.pack(padx=5, pady=5)
+        
         # --- Main Panel ---
         # A Text widget for logging.
         self.log_text = tk.Text(self.main_frame, height=15)
@@ -237,56 +178,176 @@ class Application(tk.Tk):
         self.insert_button.pack(padx=5, pady=5)
     
     def populate_treeview(self):
-        """Recursively populate the treeview with folders under the png directory."""
+        """
+        Reset the treeview to the png root. Subfolders are read in the
+        background when a node is expanded, so this returns immediately
+        however large the image library is.
+        """
         # Clear any existing items.
         for i in self.tree.get_children():
             self.tree.delete(i)
+        self._loaded_nodes.clear()
             
         # Insert the root node for the png folder.
         root_node = self.tree.insert("", "end", text="png", open=True, values=(self.png_dir,))
-        self._process_directory(root_node, self.png_dir)
+        self._load_children_async([(root_node, self.png_dir)])
     
-    def _process_directory(self, parent, path):
-        try:
-            entries = os.listdir(path)
-        except Exception as e:
-            self.log(f"Error listing {path}: {e}")
+    def _insert_directory_node(self, parent, index, name, path):
+        node = self.tree.insert(parent, index, text=name, open=False, values=(path,))
+        # Placeholder child so the node can be expanded before it is listed.
+        self.tree.insert(node, "end", text="…", values=("",))
+        return node
+    
+    def on_tree_open(self, event):
+        node = self.tree.focus()
+        if node and node not in self._loaded_nodes:
+            path = self.tree.item(node, "values")[0]
+            self._load_children_async([(node, path)])
+    
+    def refresh_treeview(self):
+        """Re-list every expanded folder in the background and apply the changes."""
+        self._load_children_async(list(self._loaded_nodes.items()))
+    
+    def _load_children_async(self, nodes):
+        """List the subfolders of each (node, path) on a worker thread."""
+        for node, path in nodes:
+            self._loaded_nodes[node] = path
+        thread = threading.Thread(target=self._list_children, args=(nodes,), daemon=True)
+        thread.start()
+    
+    def _list_children(self, nodes):
+        for node, path in nodes:
+            try:
+                # DirEntry.is_dir() uses the type info returned by the directory
+                # read, so no extra stat per entry.
+                with os.scandir(path) as entries:
+                    subdirs = sorted((entry.name, entry.path) for entry in entries
+                                     if entry.is_dir())
+            except OSError as e:
+                self.log(f"Error listing {path}: {e}")
+                subdirs = []
+            self.run_in_ui(lambda node=node, subdirs=subdirs: self._fill_node(node, subdirs))
+    
+    def _fill_node(self, node, subdirs):
+        """Make node's children match subdirs, keeping already-listed folders."""
+        if not self.tree.exists(node):
             return
-        for entry in sorted(entries):
-            full_path = os.path.join(path, entry)
-            if os.path.isdir(full_path):
-                node = self.tree.insert(parent, "end", text=entry, open=False, values=(full_path,))
-                self._process_directory(node, full_path)
+        existing = {}
+        for child in self.tree.get_children(node):
+            child_path = self.tree.item(child, "values")[0]
+            if child_path:
+                existing[child_path] = child
+            else:
+                self.tree.delete(child)  # placeholder
+        wanted = {path for _, path in subdirs}
+        for child_path, child in existing.items():
+            if child_path not in wanted:
+                self._forget_node(child)
+                self.tree.delete(child)
+        for index, (name, path) in enumerate(subdirs):
+            if path in existing:
+                self.tree.move(existing[path], node, index)
+            else:
+                self._insert_directory_node(node, index, name, path)
+    
+    def _forget_node(self, node):
+        self._loaded_nodes.pop(node, None)
+        for child in self.tree.get_children(node):
+            self._forget_node(child)
     
     def log(self, message):
-        """Append a message to the log console."""
-        self.log_text.insert(tk.END, message + "\n")
-        self.log_text.see(tk.END)
-        self.update_idletasks()
+        """Queue a message for the log console (safe to call from any thread)."""
+        self.ui_events.put(("log", message))
     
     def update_progress(self, value, maximum):
-        """Update the progress bar."""
-        self.progress["maximum"] = maximum
-        self.progress["value"] = value
-        self.update_idletasks()
+        """Queue a progress bar update (safe to call from any thread)."""
+        self.ui_events.put(("progress", (value, maximum)))
     
     def flash_image(self, image_path):
+        """Queue an image preview (safe to call from any thread)."""
+        self.ui_events.put(("preview", image_path))
+    
+    def run_in_ui(self, func):
+        """Queue func to be called on the Tk thread."""
+        self.ui_events.put(("call", func))
+    
+    def _pump_ui_events(self):
         """
-        Load and display the image briefly in the image preview area.
-        (If the image is too large, it is thumbnailed.)
+        Drain queued events once per frame: log lines are inserted in one
+        batch, and only the latest progress value and preview are applied,
+        so UI cost stays flat however many files are processed. Previews are
+        decoded by the PreviewLoader thread; a finished one is shown here.
+        An event that fails is logged and the pump keeps running.
         """
         try:
-            img = Image.open(image_path)
-            img.thumbnail((300, 300))
+            lines = []
+            progress = None
+            preview = None
+            calls = []
+            try:
+                while True:
+                    kind, payload = self.ui_events.get_nowait()
+                    if kind == "log":
+                        lines.append(payload)
+                    elif kind == "progress":
+                        progress = payload
+                    elif kind == "preview":
+                        preview = payload
+                    else:
+                        calls.append(payload)
+            except queue.Empty:
+                pass
+            
+            if lines:
+                self._run_event(self._append_log_lines, lines[-LOG_MAX_LINES:])
+            if progress is not None:
+                self._run_event(self._set_progress, *progress)
+            if preview is not None:
+                self.preview_loader.request(preview)
+            result = self.preview_loader.take_result()
+            if result is not None:
+                self._show_preview(*result)
+            for func in calls:
+                self._run_event(func)
+        finally:
+            self.after(UI_PUMP_INTERVAL_MS, self._pump_ui_events)
+    
+    def _run_event(self, func, *args):
+        try:
+            func(*args)
+        except Exception as e:
+            self.log(f"Error updating the UI: {e}")
+    
+    def _set_progress(self, value, maximum):
+        self.progress["maximum"] = maximum
+        self.progress["value"] = value
+    
+    def _append_log_lines(self, lines):
+        self.log_text.insert(tk.END, "\n".join(lines) + "\n")
+        # Drop the oldest lines beyond LOG_MAX_LINES.
+        line_count = int(self.log_text.index("end-1c").split(".")[0])
+        if line_count > LOG_MAX_LINES:
+            self.log_text.delete("1.0", f"{line_count - LOG_MAX_LINES}.0")
+        self.log_text.see(tk.END)
+    
+    def _show_preview(self, image_path, img):
+        """Display a decoded preview briefly in the image preview area."""
+        try:
             photo = ImageTk.PhotoImage(img)
             self.image_label.config(image=photo)
             self.image_label.image = photo  # keep a reference
-            self.update_idletasks()
-            # Remove the image after 500 ms.
-            self.after(500, lambda: self.image_label.config(image=""))
+            # Remove the image after PREVIEW_DISPLAY_MS, unless a newer one replaces it first.
+            if self._preview_clear_id is not None:
+                self.after_cancel(self._preview_clear_id)
+            self._preview_clear_id = self.after(PREVIEW_DISPLAY_MS, self._clear_preview)
         except Exception as e:
             self.log(f"Error displaying image {image_path}: {e}")
     
+    def _clear_preview(self):
+        self._preview_clear_id = None
+        self.image_label.config(image="")
+        self.image_label.image = None
+    
     def get_selected_directories(self):
         """Return a list of selected directories (full paths) from the treeview."""
         selected_items = self.tree.selection()
@@ -313,48 +374,21 @@ class Application(tk.Tk):
     
     def process_directories(self, directories):
         """Traverse the selected directories, match each PNG file to a db record, and rename it."""
-        # Collect all PNG files recursively from the selected directories.
-        file_list = []
-        for d in directories:
-            for root, _, files in os.walk(d):
-                for f in files:
-                    if f.lower().endswith(".png"):
-                        file_list.append(os.path.join(root, f))
-        total_files = len(file_list)
-        self.log(f"Found {total_files} PNG files in selected directories.")
-        
-        # Process each file.
-        for idx, file_path in enumerate(file_list, start=1):
-            genus, cultivar = get_genus_and_cultivar_from_path(self.png_dir, file_path)
-            if not genus:
-                self.log(f"Skipping file with no genus: {file_path}")
-                continue
-            file_key = extract_file_key(os.path.basename(file_path), genus, cultivar)
-            candidates = find_candidate_record(file_key, genus, cultivar, self.db_records)
-            
-            if len(candidates) == 1:
-                record = candidates[0]
-                # New filename format: {id}[{tag_name}].png
-                new_filename = f"{record['id']}[{record['tag_name']}].png"
-                new_full_path = os.path.join(os.path.dirname(file_path), new_filename)
-                try:
-                    os.rename(file_path, new_full_path)
-                    self.log(f"Renamed:\n  {file_path}\n  -> {new_full_path}")
-                    self.flash_image(new_full_path)
-                except Exception as e:
-                    self.log(f"Error renaming {file_path}: {e}")
-            elif len(candidates) == 0:
-                self.log(f"No match for file:\n  {file_path}\n  (file key: {file_key})")
-            else:
-                self.log(f"Multiple matches for file:\n  {file_path}\n  (file key: {file_key})")
-                self.log(f"Candidates: {candidates}")
-            
-            # Update progress.
-            self.update_progress(idx, total_files)
-            time.sleep(0.1)  # a small delay for smoother UI feedback
-        
+        manifest = ProcessedManifest(self.manifest_path)
+        match_cache = MatchCache(manifest.conn)
+        try:
+            stats = imagepipeline.process_directories(
+                directories, self.png_dir, self.candidate_index,
+                log=self.log, progress=self.update_progress, on_renamed=self.flash_image,
+                workers=imagepipeline.resolve_workers(0), manifest=manifest,
+                match_cache=match_cache,
+            )
+        finally:
+            manifest.close()
+        stats['metrics'].write_json(imagepipeline.default_metrics_path(self.db_path))
+        self.log(imagepipeline.format_summary(stats))
         self.log("Processing complete.")
-        self.run_button.config(state=tk.NORMAL)
+        self.run_in_ui(lambda: self.run_button.config(state=tk.NORMAL))
     
     def insert_applicable_images(self):
         """Disable the button and run the image insertion in a separate thread."""
@@ -364,53 +398,21 @@ class Application(tk.Tk):
     
     def process_images_insertion(self):
         """Process images for insertion into CatalogImages table."""
-        pattern = re.compile(r'^(\d+)\[(.+?)\]\.png$', re.IGNORECASE)
-        file_list = []
-        for root, dirs, files in os.walk(self.png_dir):
-            for f in files:
-                if pattern.match(f):
-                    file_list.append(os.path.join(root, f))
-        
-        total_files = len(file_list)
-        self.log(f"Found {total_files} applicable PNG files for insertion.")
-        if total_files == 0:
-            self.log("No applicable images found.")
-            self.insert_button.config(state=tk.NORMAL)
-            return
-        
-        conn = sqlite3.connect(self.db_path)
-        cur = conn.cursor()
-        
-        for idx, file_path in enumerate(file_list, start=1):
-            filename = os.path.basename(file_path)
-            m = pattern.match(filename)
-            if not m:
-                continue
-            
-            plant_id = int(m.group(1))
-            rel_path = os.path.relpath(file_path, self.png_dir)
-            new_path = os.path.join(self.png_complete_dir, rel_path)
-            new_dir = os.path.dirname(new_path)
-            base_name = sanitize_filename(os.path.basename(new_path))
-            new_path = os.path.join(new_dir, base_name)
-            os.makedirs(new_dir, exist_ok=True)
-            
-            try:
-                cur.execute("INSERT INTO CatalogImages (plantcatalog_id, image_path) VALUES (?, ?)", 
-                          (plant_id, new_path))
-                conn.commit()
-                self.log(f"Inserted image record for plant id {plant_id}: {new_path}")
-                self.flash_image(file_path)
-                shutil.move(file_path, new_path)
-            except Exception as e:
-                self.log(f"Error inserting or moving {file_path}: {e}")
-            
-            self.update_progress(idx, total_files)
-            time.sleep(0.1)
-        
-        conn.close()
-        self.log("Image insertion processing complete.")
-        self.insert_button.config(state=tk.NORMAL)
+        manifest = ProcessedManifest(self.manifest_path)
+        try:
+            stats = imagepipeline.process_images_insertion(
+                self.png_dir, self.png_complete_dir, self.db_path,
+                log=self.log, progress=self.update_progress, on_inserted=self.flash_image,
+                manifest=manifest,
+                workers=imagepipeline.resolve_workers(0),
+            )
+        finally:
+            manifest.close()
+        stats['metrics'].write_json(imagepipeline.default_metrics_path(self.db_path))
+        if stats['files']:
+            self.log(imagepipeline.format_summary(stats))
+            self.log("Image insertion processing complete.")
+        self.run_in_ui(lambda: self.insert_button.config(state=tk.NORMAL))
 
 if __name__ == '__main__':
     app = Application()
@@ -0,0 +1,103 @@
+"""
+Polling watcher for the png/ drop folder, used by the pipeline's watch mode.
+
+No file-system notification service is needed: every poll stats each
+directory under the root, lists only the directories whose mtime changed,
+and re-stats only files that are new or still settling. A file is handed
+out once its size and mtime have stayed the same for `settle` seconds, so
+photos that are still being copied in are left alone until they are done.
+"""
+
+import os
+import time
+
+from imagemanifest import file_state
+
+class FolderWatcher:
+    """
+    Reports PNG files under root that are new (or changed) and have settled.
+
+    Files are reported once per (size, mtime); a file replaced under the same
+    name is only noticed if its directory changes as well, which is the case
+    for copies and renames into the folder.
+    """
+
+    def __init__(self, root, settle=3.0, clock=time.monotonic):
+        self.root = root
+        self.settle = settle
+        self.clock = clock
+        self._dirs = {}      # dir -> (mtime_ns, subdirs, png paths)
+        self._pending = {}   # path -> ((size, mtime_ns), first seen with that state)
+        self._reported = {}  # path -> (size, mtime_ns) when handed out
+
+    def _scan(self):
+        """Return (all png paths, png paths in directories whose listing changed)."""
+        all_files, changed = [], []
+        seen_dirs = set()
+        stack = [self.root]
+        while stack:
+            directory = stack.pop()
+            try:
+                mtime_ns = os.stat(directory).st_mtime_ns
+            except OSError:
+                continue
+            seen_dirs.add(directory)
+            cached = self._dirs.get(directory)
+            if cached is None or cached[0] != mtime_ns:
+                subdirs, pngs = [], []
+                try:
+                    with os.scandir(directory) as entries:
+                        for entry in entries:
+                            if entry.is_dir(follow_symlinks=False):
+                                subdirs.append(entry.path)
+                            elif entry.name.lower().endswith(".png"):
+                                pngs.append(entry.path)
+                except OSError:
+                    continue
+                cached = self._dirs[directory] = (mtime_ns, subdirs, pngs)
+                changed.extend(pngs)
+            stack.extend(cached[1])
+            all_files.extend(cached[2])
+        for directory in [d for d in self._dirs if d not in seen_dirs]:
+            del self._dirs[directory]
+        return all_files, changed
+
+    def poll(self):
+        """Return the files that became ready since the last poll, sorted."""
+        now = self.clock()
+        all_files, changed = self._scan()
+        present = set(all_files)
+        for path in [p for p in self._reported if p not in present]:
+            del self._reported[path]
+
+        ready = []
+        for path in set(changed) | set(self._pending):
+            state = file_state(path) if path in present else None
+            if state is None:
+                self._pending.pop(path, None)
+                continue
+            if self._reported.get(path) == state:
+                continue
+            seen = self._pending.get(path)
+            if seen is None or seen[0] != state:
+                self._pending[path] = (state, now)
+            elif now - seen[1] >= self.settle:
+                del self._pending[path]
+                self._reported[path] = state
+                ready.append(path)
+        return sorted(ready)
+
+    def forget(self, paths):
+        """Report paths again once they have settled (e.g. files whose processing failed)."""
+        now = self.clock()
+        for path in paths:
+            self._reported.pop(path, None)
+            self._pending[path] = (None, now)
+
+    def mark_handled(self, paths):
+        """Do not report paths (e.g. files this process just created) in their current state."""
+        for path in paths:
+            state = file_state(path)
+            if state is not None:
+                self._pending.pop(path, None)
+                self._reported[path] = state
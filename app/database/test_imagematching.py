@@ -0,0 +1,159 @@
+"""
+KeyMatcher / find_candidate_record must make exactly the accept/reject
+decisions of the original linear scan with match_keys.
+
+Run with: python -m pytest -q app/database
+"""
+
+import random
+
+import pytest
+
+from imagematching import (
+    CandidateIndex,
+    CatalogRecord,
+    KeyMatcher,
+    extract_candidate_key,
+    extract_file_key,
+    find_candidate_record,
+    match_keys,
+)
+
+THRESHOLDS = (0.0, 0.5, 0.7, 0.9, 1.0)
+
+# Reference catalog: parenthesized names, genus removal, "x" hybrids,
+# multi-word names in different orders, empty keys and Camellia cultivars.
+CATALOG = [
+    {'id': 1, 'tag_name': 'Anise Banana Split', 'botanical': 'Illicium parviflorum'},
+    {'id': 2, 'tag_name': 'Anise Yellow', 'botanical': 'Illicium parviflorum'},
+    {'id': 3, 'tag_name': 'Anise Florida Sunshine', 'botanical': 'Illicium x floridanum'},
+    {'id': 4, 'tag_name': 'Anise (Swamp Star)', 'botanical': 'Illicium floridanum'},
+    {'id': 5, 'tag_name': 'Anise', 'botanical': 'Illicium'},
+    {'id': 6, 'tag_name': 'Split Banana Anise', 'botanical': 'Illicium parviflorum'},
+    {'id': 7, 'tag_name': 'Camellia Pink Perfection', 'botanical': 'Camellia japonica'},
+    {'id': 8, 'tag_name': 'Camellia Yuletide', 'botanical': 'Camellia sasanqua'},
+    {'id': 9, 'tag_name': 'Camellia Shi Shi Gashira', 'botanical': 'Camellia hiemalis'},
+    {'id': 10, 'tag_name': 'Camellia Kramers Supreme', 'botanical': 'Camellia japonica'},
+    {'id': 11, 'tag_name': 'Hydrangea Endless Summer', 'botanical': 'Hydrangea macrophylla'},
+    {'id': 12, 'tag_name': 'Hydrangea (Limelight)', 'botanical': 'Hydrangea paniculata'},
+    {'id': 13, 'tag_name': 'Hydrangea Summer Endless', 'botanical': 'Hydrangea macrophylla'},
+    {'id': 14, 'tag_name': None, 'botanical': 'Hydrangea quercifolia'},
+    {'id': 15, 'tag_name': 'Abelia x Kaleidoscope', 'botanical': "Abelia x grandiflora 'Kaleidoscope'"},
+]
+
+# (file name, genus, cultivar folder)
+FILES = [
+    ('anisebananasplit.png', 'Anise', None),
+    ('Anise Split Banana.png', 'Anise', None),
+    ('aniseyellow.png', 'Anise', None),
+    ('anise-yelow.png', 'Anise', None),
+    ('swampstar.png', 'Anise', None),
+    ('anise.png', 'Anise', None),
+    ('floridasunshine.png', 'Anise', None),
+    ('pinkperfection.png', 'Camellia', 'Japonica'),
+    ('kramerssupreme.png', 'Camellia', 'Japonica'),
+    ('yuletide.png', 'Camellia', 'Sasanqua'),
+    ('yuletide.png', 'Camellia', None),
+    ('shishigashira.png', 'Camellia', None),
+    ('endlesssummer.png', 'Hydrangea', None),
+    ('Summer Endless.png', 'Hydrangea', None),
+    ('limelight.png', 'Hydrangea', None),
+    ('hydrangea.png', 'Hydrangea', None),
+    ('kaleidoscope.png', 'Abelia', None),
+    ('nothing-like-it.png', 'Abelia', None),
+]
+
+def linear_find_candidate_record(file_key, genus, cultivar, db_records, threshold=0.7):
+    """The original find_candidate_record: a linear scan with match_keys."""
+    candidates = []
+    for record in db_records:
+        botanical_value = (record.get('botanical') or "").lower()
+        tag_name_value = (record.get('tag_name') or "").lower()
+        if (genus.lower() not in botanical_value) and (genus.lower() not in tag_name_value):
+            continue
+        if cultivar and genus.lower() == 'camellia':
+            if (cultivar.lower() not in botanical_value) and (cultivar.lower() not in tag_name_value):
+                continue
+        if match_keys(extract_candidate_key(record, genus), file_key, threshold):
+            candidates.append(record)
+    return candidates
+
+def _ids(records):
+    return [record['id'] for record in records]
+
+@pytest.mark.parametrize("threshold", THRESHOLDS)
+def test_find_candidate_record_matches_linear_scan(threshold):
+    records = [CatalogRecord.from_mapping(record) for record in CATALOG]
+    index = CandidateIndex(records)
+    for filename, genus, cultivar in FILES:
+        file_key = extract_file_key(filename, genus, cultivar)
+        expected = _ids(linear_find_candidate_record(file_key, genus, cultivar, CATALOG, threshold))
+        assert _ids(find_candidate_record(file_key, genus, cultivar, index, threshold)) == expected, filename
+        assert _ids(find_candidate_record(file_key, genus, cultivar, CATALOG, threshold)) == expected, filename
+
+def test_reference_corpus_decisions():
+    # Pin a few decisions so a change to match_keys itself is noticed too.
+    index = CandidateIndex(CATALOG)
+    assert _ids(find_candidate_record('bananasplit', 'Anise', None, index)) == [1]
+    assert _ids(find_candidate_record('splitbanana', 'Anise', None, index)) == [6]
+    assert _ids(find_candidate_record('pinkperfection', 'Camellia', 'Japonica', index)) == [7]
+    assert _ids(find_candidate_record('yuletide', 'Camellia', 'Japonica', index)) == []
+    assert _ids(find_candidate_record('limelight', 'Hydrangea', None, index)) == [12]
+
+def test_empty_keys():
+    for threshold in THRESHOLDS:
+        matcher = KeyMatcher([('', 0), ('abc', 1), ('', 2)], threshold=threshold)
+        for file_key in ('', 'abc', 'x'):
+            got = sorted(payload for _, payload in matcher.match(file_key))
+            expected = [i for i, key in enumerate(['', 'abc', '']) if match_keys(key, file_key, threshold)]
+            assert got == expected, (threshold, file_key)
+
+def test_word_fallback():
+    # No letters in common order, but the same words: accepted only by the fallback.
+    candidates = ['summer endless', 'endless summer', 'endlesssummer', '12 34']
+    matcher = KeyMatcher(((key, i) for i, key in enumerate(candidates)), threshold=1.0)
+    assert sorted(payload for _, payload in matcher.match('endless summer')) == [0, 1]
+    # Keys without words never match through the fallback.
+    assert sorted(payload for _, payload in matcher.match('34 12')) == []
+    no_fallback = KeyMatcher(((key, i) for i, key in enumerate(candidates)), threshold=1.0,
+                             word_fallback=False)
+    assert sorted(payload for _, payload in no_fallback.match('endless summer')) == [1]
+
+@pytest.mark.parametrize("threshold", THRESHOLDS)
+def test_random_keys_match_match_keys(threshold):
+    rng = random.Random(threshold)
+    alphabet = 'abcdeilnoprstuy12 '
+
+    def random_key():
+        return ''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 14)))
+
+    for _ in range(300):
+        candidates = [random_key() for _ in range(40)]
+        file_key = list(rng.choice(candidates))
+        if rng.random() < 0.3:
+            rng.shuffle(file_key)
+        file_key = ''.join(file_key)
+        if rng.random() < 0.5:
+            file_key = file_key[:-1] + rng.choice(alphabet) if file_key else random_key()
+        matcher = KeyMatcher(((key, i) for i, key in enumerate(candidates)), threshold=threshold)
+        got = sorted(payload for _, payload in matcher.match(file_key))
+        expected = [i for i, key in enumerate(candidates) if match_keys(key, file_key, threshold)]
+        assert got == expected, (candidates, file_key)
+
+def test_top_k_returns_best_scores_first():
+    candidates = ['yellow', 'yelow', 'mellow', 'bellows']
+    matcher = KeyMatcher(((key, i) for i, key in enumerate(candidates)), threshold=0.5)
+    ranked = matcher.match('yellow')
+    assert [payload for _, payload in ranked][0] == 0
+    assert [score for score, _ in ranked] == sorted((score for score, _ in ranked), reverse=True)
+    assert matcher.match('yellow', top_k=2) == ranked[:2]
+
+def test_invalidate_rereads_changed_records():
+    catalog = [dict(record) for record in CATALOG]
+    index = CandidateIndex(catalog)
+    assert _ids(find_candidate_record('limelight', 'Hydrangea', None, index)) == [12]
+    index.records[11]['botanical'] = 'Paniculata'
+    index.records[11]['tag_name'] = 'Limelight'
+    index.invalidate(12)
+    assert _ids(find_candidate_record('limelight', 'Hydrangea', None, index)) == []
+    assert _ids(index.records_for('Paniculata')) == [12]
@@ -14,6 +14,11 @@ export interface CatalogImage {
     caption?: string;
     created_at: string;
     updated_at: string;
+    // Header metadata, when recorded by the insertion pipeline.
+    width?: number | null;
+    height?: number | null;
+    format?: string | null;
+    bytes?: number | null;
 }
 
 export interface PlantCatalog {
@@ -0,0 +1,273 @@
+"""
+Deduplicating backup store for the master file.
+
+A backup is taken in two steps:
+
+  1. An instant snapshot of the file in <store>/pending: a reflink (copy-on-
+     write clone) where the filesystem supports it, otherwise a hardlink,
+     otherwise a plain copy.
+  2. On a background thread, the snapshot is split into chunks, each chunk
+     is stored once under its SHA-256 (gzip or xz compressed) in
+     <store>/chunks, the list of chunks is written to <store>/snapshots,
+     and the pending snapshot is removed.
+
+Chunks end where a "# Content from" section starts, so two backups of a
+master file that differ in one source file share every other section.
+Retention keeps the newest `keep` snapshots, drops snapshots taken more
+than `max_age_days` ago (never the newest one), and deletes chunks no
+snapshot uses any more.
+
+A hardlink snapshot shares the master file's inode until it is ingested;
+MasterWriter gives the master file its own inode before writing to it.
+"""
+
+import gzip
+import hashlib
+import json
+import lzma
+import os
+import queue
+import shutil
+import threading
+import time
+from datetime import datetime
+
+# Chunks are cut before each section header of the master file (written
+# with the platform's line endings) ...
+SECTION_MARKER = f"{os.linesep}{os.linesep}# Content from ".encode('ascii')
+# ... and are never larger than this.
+CHUNK_MAX_SIZE = 4 * 1024 * 1024
+READ_SIZE = 1024 * 1024
+
+# Snapshot ids are the time the backup was taken.
+SNAPSHOT_ID_FORMAT = '%Y%m%d%H%M%S%f'
+
+BACKUP_KEEP = 20
+BACKUP_MAX_AGE_DAYS = 30
+
+COMPRESSORS = {
+    # name: (extension, open function)
+    'gzip': ('.gz', gzip.open),
+    'xz': ('.xz', lzma.open),
+}
+
+# Linux FICLONE ioctl (btrfs, XFS, ...): clone a file's extents copy-on-write.
+_FICLONE = 0x40049409
+
+def reflink(src, dst):
+    """Make dst a copy-on-write clone of src; raises OSError where unsupported."""
+    try:
+        import fcntl
+    except ImportError:
+        raise OSError("reflink is not supported on this platform")
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        try:
+            fcntl.ioctl(d.fileno(), _FICLONE, s.fileno())
+        except OSError:
+            d.close()
+            os.remove(dst)
+            raise
+
+def snapshot_file(src, dst):
+    """Snapshot src to dst as cheaply as possible; returns 'reflink', 'hardlink' or 'copy'."""
+    try:
+        reflink(src, dst)
+        return 'reflink'
+    except OSError:
+        pass
+    try:
+        os.link(src, dst)
+        return 'hardlink'
+    except OSError:
+        pass
+    shutil.copy2(src, dst)
+    return 'copy'
+
+def iter_chunks(path, marker=SECTION_MARKER, max_size=CHUNK_MAX_SIZE):
+    """Yield the bytes of path in chunks that start at marker (or every max_size bytes)."""
+    with open(path, 'rb') as f:
+        buffer = b""
+        while True:
+            data = f.read(READ_SIZE)
+            buffer += data
+            cut = buffer.find(marker, 1)
+            while cut != -1:
+                yield buffer[:cut]
+                buffer = buffer[cut:]
+                cut = buffer.find(marker, 1)
+            while len(buffer) >= max_size:
+                yield buffer[:max_size]
+                buffer = buffer[max_size:]
+            if not data:
+                if buffer:
+                    yield buffer
+                return
+
+class BackupStore:
+    """
+    Snapshots of one file, stored as deduplicated compressed chunks.
+
+    backup() returns as soon as the snapshot is taken; chunking, compression
+    and retention run on one background thread per store. Call wait() to
+    block until queued backups are stored. Snapshots left in pending by an
+    earlier process are ingested when the store is opened.
+    """
+
+    def __init__(self, directory, keep=BACKUP_KEEP, max_age_days=BACKUP_MAX_AGE_DAYS,
+                 compression='gzip', log=print):
+        self.directory = directory
+        self.keep = keep
+        self.max_age_days = max_age_days
+        self.compression = compression
+        self.log = log
+        self.pending_dir = os.path.join(directory, "pending")
+        self.chunks_dir = os.path.join(directory, "chunks")
+        self.snapshots_dir = os.path.join(directory, "snapshots")
+        for d in (self.pending_dir, self.chunks_dir, self.snapshots_dir):
+            os.makedirs(d, exist_ok=True)
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name="backup-store", daemon=True)
+        self._worker.start()
+        for name in sorted(os.listdir(self.pending_dir)):
+            if not name.endswith(".tmp"):
+                self._queue.put(name)
+
+    def backup(self, path, log=None):
+        """Snapshot path now and queue it for storing. Returns the snapshot id."""
+        log = log or self.log
+        snapshot_id = datetime.now().strftime(SNAPSHOT_ID_FORMAT)
+        pending = os.path.join(self.pending_dir, snapshot_id)
+        method = snapshot_file(path, pending)
+        log(f"Backup snapshot {snapshot_id} taken ({method}); storing it in the background.")
+        self._queue.put(snapshot_id)
+        return snapshot_id
+
+    def wait(self):
+        """Block until every queued snapshot has been stored."""
+        self._queue.join()
+
+    def _run(self):
+        while True:
+            snapshot_id = self._queue.get()
+            try:
+                self._ingest(snapshot_id)
+                self.prune()
+            except Exception as e:
+                self.log(f"Error storing backup {snapshot_id}: {e}")
+            finally:
+                self._queue.task_done()
+
+    # ---------------------------------------------------------------
+    # Storing
+    # ---------------------------------------------------------------
+    def _chunk_path(self, digest, extension):
+        return os.path.join(self.chunks_dir, digest[:2], digest + extension)
+
+    def _ingest(self, snapshot_id):
+        pending = os.path.join(self.pending_dir, snapshot_id)
+        extension, opener = COMPRESSORS[self.compression]
+        chunks = []
+        size = 0
+        added = 0
+        for data in iter_chunks(pending):
+            digest = hashlib.sha256(data).hexdigest()
+            chunks.append(digest + extension)
+            size += len(data)
+            if self._find_chunk(digest) is None:
+                path = self._chunk_path(digest, extension)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with opener(path + ".tmp", 'wb') as f:
+                    f.write(data)
+                os.replace(path + ".tmp", path)
+                added += len(data)
+        # Not the snapshot's mtime: hardlinks and copies keep the master file's.
+        created = datetime.strptime(snapshot_id, SNAPSHOT_ID_FORMAT).timestamp()
+        latest = self.latest()
+        if latest is None or latest['chunks'] != chunks:
+            self._write_json(os.path.join(self.snapshots_dir, snapshot_id + ".json"), {
+                'id': snapshot_id,
+                'created': created,
+                'size': size,
+                'chunks': chunks,
+            })
+            self.log(f"Backup {snapshot_id} stored: {size} bytes, {added} bytes of new chunks.")
+        else:
+            self.log(f"Backup {snapshot_id} is identical to backup {latest['id']}; not kept.")
+        os.remove(pending)
+
+    def _find_chunk(self, digest):
+        for extension, _ in COMPRESSORS.values():
+            path = self._chunk_path(digest, extension)
+            if os.path.exists(path):
+                return path
+        return None
+
+    @staticmethod
+    def _write_json(path, data):
+        with open(path + ".tmp", 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(path + ".tmp", path)
+
+    # ---------------------------------------------------------------
+    # Listing, restoring and retention
+    # ---------------------------------------------------------------
+    def snapshots(self):
+        """Return the stored snapshot records, oldest first."""
+        records = []
+        for name in sorted(os.listdir(self.snapshots_dir)):
+            if name.endswith(".json"):
+                with open(os.path.join(self.snapshots_dir, name), 'r', encoding='utf-8') as f:
+                    records.append(json.load(f))
+        return records
+
+    def latest(self):
+        records = self.snapshots()
+        return records[-1] if records else None
+
+    def restore(self, snapshot_id, dest):
+        """Write the content of snapshot snapshot_id to dest."""
+        with open(os.path.join(self.snapshots_dir, snapshot_id + ".json"), 'r', encoding='utf-8') as f:
+            record = json.load(f)
+        with open(dest + ".tmp", 'wb') as out:
+            for name in record['chunks']:
+                digest, extension = os.path.splitext(name)
+                opener = next(o for ext, o in COMPRESSORS.values() if ext == extension)
+                with opener(self._chunk_path(digest, extension), 'rb') as f:
+                    shutil.copyfileobj(f, out, READ_SIZE)
+        os.replace(dest + ".tmp", dest)
+
+    def prune(self):
+        """
+        Apply the count/age retention and delete chunks no snapshot refers to.
+        The newest snapshot is always kept.
+        """
+        records = self.snapshots()
+        cutoff = time.time() - self.max_age_days * 86400 if self.max_age_days is not None else None
+        keep_from = max(0, len(records) - max(self.keep, 1)) if self.keep is not None else 0
+        kept = []
+        for index, record in enumerate(records):
+            newest = index == len(records) - 1
+            if not newest and (index < keep_from or (cutoff is not None and record['created'] < cutoff)):
+                os.remove(os.path.join(self.snapshots_dir, record['id'] + ".json"))
+            else:
+                kept.append(record)
+        used = {name for record in kept for name in record['chunks']}
+        for sub in os.listdir(self.chunks_dir):
+            sub_dir = os.path.join(self.chunks_dir, sub)
+            for name in os.listdir(sub_dir):
+                if name not in used:
+                    os.remove(os.path.join(sub_dir, name))
+            if not os.listdir(sub_dir):
+                os.rmdir(sub_dir)
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+def backup_store_for(master_filename, **options):
+    """Return the (shared) BackupStore of master_filename, "<master>.backups"."""
+    directory = os.path.abspath(f"{master_filename}.backups")
+    with _stores_lock:
+        store = _stores.get(directory)
+        if store is None:
+            store = _stores[directory] = BackupStore(directory, **options)
+        return store
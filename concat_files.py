@@ -23,12 +23,12 @@ Simply run this script, load a directory, and begin selecting files.
 """
 
 import os
-import shutil
 from datetime import datetime
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox, scrolledtext, END
 import threading
 import file_io_utils
+import file_explorer
 
 
 class FileConcatenatorApp(tk.Tk):
@@ -42,6 +42,11 @@ class FileConcatenatorApp(tk.Tk):
         self.master_filename = 'master.txt'
         self.tree_item_to_path = {}
         self.tree_item_original_text = {}
+        # Directory nodes whose children are not loaded yet -> their placeholder child.
+        self.tree_unloaded = {}
+        self.lister = file_explorer.DirectoryLister()
+        self.previewer = file_explorer.PreviewService()
+        self.preview_token = None
 
         # Use a PanedWindow to separate explorer and file list
         self.paned = ttk.PanedWindow(self, orient="horizontal")
@@ -58,6 +63,8 @@ class FileConcatenatorApp(tk.Tk):
         self.create_explorer_widgets()
         self.create_main_widgets()
         self.log("Application started. Use 'Load Directory' to select a folder.")
+        self.after(50, self.poll_listings)
+        self.after(30, self.poll_previews)
 
     def create_explorer_widgets(self):
         # Button to load a directory
@@ -84,6 +91,7 @@ class FileConcatenatorApp(tk.Tk):
         # Bind events
         self.tree_files.bind("<Double-1>", self.on_tree_item_double_click)
         self.tree_files.bind("<<TreeviewSelect>>", self.on_tree_selection)
+        self.tree_files.bind("<<TreeviewOpen>>", self.on_tree_open)
         self.tree_files.bind("<Button-3>", self.show_context_menu)
 
         # Add vertical scrollbar for tree
@@ -163,17 +171,8 @@ class FileConcatenatorApp(tk.Tk):
         self.log("Cleared file list.")
 
     def create_backup(self):
-        """Create a backup of the master file (if it exists) with a timestamp."""
-        if os.path.exists(self.master_filename):
-            timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-            backup_filename = f"{self.master_filename}.{timestamp}.bak"
-            try:
-                shutil.copy2(self.master_filename, backup_filename)
-                self.log(f"Backup created: {backup_filename}")
-            except Exception as e:
-                self.log(f"Error creating backup: {str(e)}")
-        else:
-            self.log("No existing master file found; skipping backup.")
+        """Snapshot the master file (if it exists) into its backup store."""
+        file_io_utils.create_backup(self.master_filename, self.log)
 
     def load_file(self, filename):
         """Load and return the content of a file."""
@@ -225,18 +224,9 @@ class FileConcatenatorApp(tk.Tk):
         t.start()
 
     def run_concatenation(self, files):
-        file_io_utils.create_backup(self.master_filename, self.log)
-        try:
-            open(self.master_filename, 'w').close()
-            self.log("Cleared existing master file.")
-        except Exception as e:
-            self.log(f"Error clearing master file: {e}")
+        self.create_backup()
+        if file_io_utils.concatenate(self.master_filename, files, self.log) is None:
             return
-        file_io_utils.write_directory_structure(self.master_filename, files, self.log)
-        for file in files:
-            content = file_io_utils.load_file(file, self.log)
-            if content is not None:
-                file_io_utils.append_to_master(self.master_filename, file, content, self.log)
         self.log("Concatenation process completed.")
         messagebox.showinfo("Completed", f"Files have been concatenated into {self.master_filename}.")
 
@@ -248,12 +238,16 @@ class FileConcatenatorApp(tk.Tk):
         self.tree_files.delete(*self.tree_files.get_children())
         self.tree_item_to_path.clear()
         self.tree_item_original_text.clear()
+        self.tree_unloaded.clear()
+        self.lister.reset()
         self.populate_tree("", dir_selected)
         self.log(f"Loaded directory: {dir_selected}")
 
-    def get_indicator(self, path):
+    def get_indicator(self, path, is_dir=None):
         """Return an icon based on file type or folder."""
-        if os.path.isdir(path):
+        if is_dir is None:
+            is_dir = os.path.isdir(path)
+        if is_dir:
             return "📁"
         ext = os.path.splitext(path)[1].lower()
         mapping = {
@@ -270,28 +264,58 @@ class FileConcatenatorApp(tk.Tk):
         return mapping.get(ext, "📄")
 
     def populate_tree(self, parent, path):
-        """Recursively populate the tree with directories and files from the given path."""
+        """
+        Add the directory path under parent. Its children are listed in the
+        background when the node is first opened; the root node is opened
+        right away.
+        """
         basename = os.path.basename(path)
         if not basename:
             basename = path  # For root directories
-        icon = self.get_indicator(path)
-        display_text = f"{icon} {basename}"
+        node = self.insert_tree_node(parent, basename, path, True)
+        if not parent:
+            self.tree_files.item(node, open=True)
+            self.load_tree_node(node)
+
+    def insert_tree_node(self, parent, name, path, is_dir):
+        display_text = f"{self.get_indicator(path, is_dir)} {name}"
         node = self.tree_files.insert(parent, 'end', text=display_text, open=False)
         self.tree_item_to_path[node] = path
         self.tree_item_original_text[node] = display_text
-        try:
-            for entry in os.listdir(path):
-                full_entry = os.path.join(path, entry)
-                if os.path.isdir(full_entry):
-                    self.populate_tree(node, full_entry)
-                else:
-                    file_icon = self.get_indicator(full_entry)
-                    file_display = f"{file_icon} {entry}"
-                    file_node = self.tree_files.insert(node, 'end', text=file_display)
-                    self.tree_item_to_path[file_node] = full_entry
-                    self.tree_item_original_text[file_node] = file_display
-        except PermissionError:
-            pass  # Skip directories that cannot be accessed
+        if is_dir:
+            # A placeholder child, so the node can be expanded before it is listed.
+            self.tree_unloaded[node] = self.tree_files.insert(node, 'end', text="Loading...")
+        return node
+
+    def load_tree_node(self, node):
+        """Start listing node's directory, unless it was listed already."""
+        if node in self.tree_unloaded:
+            self.lister.request(node, self.tree_item_to_path[node])
+
+    def on_tree_open(self, event):
+        self.load_tree_node(self.tree_files.focus())
+
+    def poll_listings(self):
+        """Add the directory listings finished by the background lister to the tree."""
+        for node, path, entries, error in self.lister.results():
+            placeholder = self.tree_unloaded.pop(node, None)
+            if placeholder is None or not self.tree_files.exists(node):
+                continue  # The tree was reloaded meanwhile, or node was loaded already.
+            if error is not None:
+                self.tree_files.item(placeholder, text=f"Cannot list directory: {error.strerror or error}")
+                continue
+            self.tree_files.delete(placeholder)
+            self.fill_tree_node(node, entries)
+        self.after(50, self.poll_listings)
+
+    def fill_tree_node(self, node, entries, start=0, batch_size=500):
+        """Insert entries under node, batch_size at a time so large directories do not freeze the window."""
+        if not self.tree_files.exists(node):
+            return
+        for name, path, is_dir in entries[start:start + batch_size]:
+            self.insert_tree_node(node, name, path, is_dir)
+        if start + batch_size < len(entries):
+            self.after(1, self.fill_tree_node, node, entries, start + batch_size, batch_size)
 
     def on_tree_item_double_click(self, event):
         """Toggle file inclusion when a user double-clicks a file node."""
@@ -323,24 +347,23 @@ class FileConcatenatorApp(tk.Tk):
             self.tree_files.tag_configure("selected", background="lightblue")
 
     def on_tree_selection(self, event):
-        """Update preview panel with first few lines of the selected file."""
+        """Request a preview of the first few lines of the selected file."""
         selected = self.tree_files.selection()
-        if not selected:
-            self.preview_text.delete("1.0", END)
-            return
-        item = selected[0]
-        path = self.tree_item_to_path.get(item)
-        if path and os.path.isfile(path):
-            try:
-                with open(path, "r", encoding="utf-8") as f:
-                    lines = f.readlines()[:10]
-                preview = "".join(lines)
-            except Exception as e:
-                preview = f"Error previewing file: {e}"
+        path = self.tree_item_to_path.get(selected[0]) if selected else None
+        if path:
+            self.preview_token = self.previewer.request(path)
         else:
-            preview = ""
-        self.preview_text.delete("1.0", END)
-        self.preview_text.insert("1.0", preview)
+            self.previewer.cancel()
+            self.preview_token = None
+            self.preview_text.delete("1.0", END)
+
+    def poll_previews(self):
+        """Show the preview of the current selection once the background reader has it."""
+        for token, path, preview in self.previewer.results():
+            if token == self.preview_token:
+                self.preview_text.delete("1.0", END)
+                self.preview_text.insert("1.0", preview)
+        self.after(30, self.poll_previews)
 
     def show_context_menu(self, event):
         """Show a context menu to toggle file inclusion on right-click."""
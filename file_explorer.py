@@ -0,0 +1,254 @@
+"""
+Directory listing and file previews for the file explorer of concat_files.
+
+Directories are listed one level at a time, with os.scandir, on a
+background thread, when their node is first expanded. Entries matching
+gitignore-style rules (DEFAULT_IGNORES plus the .gitignore files found on
+the way down) are left out, so node_modules, .git and .next are never
+walked.
+
+Previews are read on another background thread from a bounded head of the
+file and cached by (size, mtime); a new selection supersedes the previous
+request.
+"""
+
+import codecs
+import fnmatch
+import os
+import queue
+import stat
+import threading
+from collections import OrderedDict
+
+DEFAULT_IGNORES = (
+    '.git/',
+    'node_modules/',
+    '.next/',
+    '__pycache__/',
+    '.venv/',
+    '*.pyc',
+    '.DS_Store',
+    '*.backups/',
+)
+
+# A preview shows this many lines, read from at most this many bytes.
+PREVIEW_LINES = 10
+PREVIEW_HEAD_SIZE = 64 * 1024
+# Previews kept in the LRU cache.
+PREVIEW_CACHE_SIZE = 256
+
+def parse_ignore_rule(line):
+    """
+    Parse one .gitignore line into (pattern, negate, dir_only, anchored),
+    or None for blank lines and comments.
+    """
+    line = line.strip()
+    if not line or line.startswith('#'):
+        return None
+    negate = line.startswith('!')
+    if negate:
+        line = line[1:]
+    dir_only = line.endswith('/')
+    line = line.rstrip('/')
+    if line.startswith('**/'):
+        line = line[3:]
+    anchored = '/' in line
+    line = line.lstrip('/')
+    return (line, negate, dir_only, anchored) if line else None
+
+class IgnoreRules:
+    """
+    An immutable list of gitignore-style rules. As in git, the last rule
+    matching an entry decides, and '!' rules re-include entries. Patterns
+    containing a '/' match the path relative to the directory of their
+    .gitignore file; other patterns match the entry name.
+    """
+
+    def __init__(self, rules=()):
+        # (base directory, pattern, negate, dir_only, anchored)
+        self.rules = tuple(rules)
+
+    @classmethod
+    def from_patterns(cls, patterns, base=''):
+        return cls((base,) + rule for rule in map(parse_ignore_rule, patterns) if rule)
+
+    def for_directory(self, directory):
+        """Return these rules followed by those of directory/.gitignore, if it has one."""
+        try:
+            with open(os.path.join(directory, '.gitignore'), 'r', encoding='utf-8', errors='replace') as f:
+                added = IgnoreRules.from_patterns(f, directory).rules
+        except OSError:
+            return self
+        return IgnoreRules(self.rules + added) if added else self
+
+    def ignored(self, path, name, is_dir):
+        result = False
+        for base, pattern, negate, dir_only, anchored in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if anchored:
+                if not base:
+                    continue
+                target = os.path.relpath(path, base).replace(os.sep, '/')
+            else:
+                target = name
+            if fnmatch.fnmatchcase(target, pattern):
+                result = not negate
+        return result
+
+class DirectoryLister:
+    """
+    Lists directories on a background thread.
+
+    request(key, path) queues a listing; results() yields the finished ones
+    as (key, path, entries, error) without blocking, where entries is a list
+    of (name, path, is_dir), directories first. Call results() from the GUI
+    thread (e.g. from a Tk after() loop); the worker never touches widgets.
+    """
+
+    def __init__(self, rules=None):
+        self.rules = rules if rules is not None else IgnoreRules.from_patterns(DEFAULT_IGNORES)
+        self._requests = queue.Queue()
+        self._results = queue.Queue()
+        self._dir_rules = {}  # directory -> rules for its entries (worker thread only)
+        threading.Thread(target=self._run, name="directory-lister", daemon=True).start()
+
+    def request(self, key, path):
+        self._requests.put((key, path))
+
+    def reset(self):
+        """Forget the .gitignore rules read so far (e.g. when a new root is loaded)."""
+        self._requests.put(None)
+
+    def results(self):
+        while True:
+            try:
+                yield self._results.get_nowait()
+            except queue.Empty:
+                return
+
+    def _run(self):
+        while True:
+            request = self._requests.get()
+            if request is None:
+                self._dir_rules.clear()
+                continue
+            key, path = request
+            try:
+                self._results.put((key, path, self.list_directory(path), None))
+            except OSError as e:
+                self._results.put((key, path, None, e))
+
+    def list_directory(self, path):
+        rules = self._dir_rules.get(os.path.dirname(path), self.rules).for_directory(path)
+        self._dir_rules[path] = rules
+        entries = []
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if not rules.ignored(entry.path, entry.name, is_dir):
+                    entries.append((entry.name, entry.path, is_dir))
+        entries.sort(key=lambda e: (not e[2], e[0].lower()))
+        return entries
+
+def read_preview(path, max_lines=PREVIEW_LINES, head_size=PREVIEW_HEAD_SIZE):
+    """
+    Return the first max_lines lines of the file at path, reading at most
+    head_size bytes of it. Files with a NUL byte in that head are reported
+    as binary; raises UnicodeDecodeError for other non-UTF-8 files.
+    """
+    with open(path, 'rb') as f:
+        head = f.read(head_size)
+        size = os.fstat(f.fileno()).st_size
+    if b'\0' in head:
+        return f"Binary file ({size} bytes)."
+    # Not final: the head may end inside a multi-byte character.
+    text = codecs.getincrementaldecoder('utf-8')().decode(head)
+    lines = text.replace('\r\n', '\n').replace('\r', '\n').split('\n', max_lines)
+    if len(lines) > max_lines:
+        return '\n'.join(lines[:max_lines]) + '\n'
+    return '\n'.join(lines)
+
+class PreviewService:
+    """
+    Reads file previews (see read_preview) on a background thread.
+
+    request(path) returns a token; results() yields finished previews as
+    (token, path, preview) without blocking. Only the newest request is
+    served: requests made while the worker was busy replace each other, and
+    a preview finished after a newer request (or cancel()) is dropped, so
+    only the latest token is ever reported. Previews are kept in an LRU
+    cache of cache_size entries and reused while the file's size and mtime
+    are unchanged.
+    """
+
+    def __init__(self, cache_size=PREVIEW_CACHE_SIZE, max_lines=PREVIEW_LINES, head_size=PREVIEW_HEAD_SIZE):
+        self.cache_size = cache_size
+        self.max_lines = max_lines
+        self.head_size = head_size
+        self._cache = OrderedDict()  # path -> ((size, mtime_ns), preview) (worker thread only)
+        self._condition = threading.Condition()
+        self._token = 0
+        self._next = None  # (token, path) waiting for the worker
+        self._results = queue.Queue()
+        threading.Thread(target=self._run, name="file-preview", daemon=True).start()
+
+    def request(self, path):
+        with self._condition:
+            self._token += 1
+            self._next = (self._token, path)
+            self._condition.notify()
+            return self._token
+
+    def cancel(self):
+        """Drop the pending request and any preview still being read."""
+        with self._condition:
+            self._token += 1
+            self._next = None
+
+    def results(self):
+        while True:
+            try:
+                yield self._results.get_nowait()
+            except queue.Empty:
+                return
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._next is None:
+                    self._condition.wait()
+                token, path = self._next
+                self._next = None
+            preview = self.preview(path)
+            with self._condition:
+                if token == self._token:
+                    self._results.put((token, path, preview))
+
+    def preview(self, path):
+        """Return the preview text of path (empty for directories), from the cache when it is current."""
+        try:
+            st = os.stat(path)
+        except OSError as e:
+            return f"Error previewing file: {e}"
+        if not stat.S_ISREG(st.st_mode):
+            return ""
+        state = (st.st_size, st.st_mtime_ns)
+        cached = self._cache.get(path)
+        if cached is not None and cached[0] == state:
+            self._cache.move_to_end(path)
+            return cached[1]
+        try:
+            preview = read_preview(path, self.max_lines, self.head_size)
+        except UnicodeDecodeError:
+            preview = "Not a UTF-8 text file."
+        except OSError as e:
+            return f"Error previewing file: {e}"
+        self._cache[path] = (state, preview)
+        self._cache.move_to_end(path)
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return preview
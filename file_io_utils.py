@@ -1,14 +1,37 @@
+import codecs
+import errno
+import hashlib
+import json
 import os
 import shutil
-from datetime import datetime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 
-def create_backup(master_filename, log):
+from backup_store import BACKUP_KEEP, BACKUP_MAX_AGE_DAYS, backup_store_for
+
+# Files are copied into the master file this many bytes at a time.
+COPY_CHUNK_SIZE = 1024 * 1024
+# Files read ahead of the writer, and the most bytes they may hold in memory.
+READ_AHEAD_FILES = 8
+READ_AHEAD_BYTES = 64 * 1024 * 1024
+
+# Errors meaning "this zero-copy call is not supported here"; fall back to the next method.
+_FALLBACK_ERRNOS = {getattr(errno, name) for name in
+                    ('EXDEV', 'ENOSYS', 'EINVAL', 'ENOTSOCK', 'EOPNOTSUPP', 'ENOTSUP')
+                    if hasattr(errno, name)}
+
+def create_backup(master_filename, log, keep=BACKUP_KEEP, max_age_days=BACKUP_MAX_AGE_DAYS):
+    """
+    Snapshot the master file into its backup store ("<master>.backups", see
+    backup_store). Keeps the newest keep backups that are at most
+    max_age_days old.
+    """
     if os.path.exists(master_filename):
-        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-        backup_filename = f"{master_filename}.{timestamp}.bak"
         try:
-            shutil.copy2(master_filename, backup_filename)
-            log(f"Backup created: {backup_filename}")
+            store = backup_store_for(master_filename)
+            store.keep, store.max_age_days, store.log = keep, max_age_days, log
+            store.backup(master_filename, log)
         except Exception as e:
             log(f"Error creating backup: {e}")
     else:
@@ -45,3 +68,424 @@ def write_directory_structure(master_filename, file_list, log):
         log("Directory structure written to master file.")
     except Exception as e:
         log(f"Error writing directory structure: {e}")
+
+# Text goes into the master file as the original text-mode code wrote it:
+# line endings read as universal newlines, written as os.linesep.
+_LINESEP = os.linesep.encode('ascii')
+
+def _translate_newlines(data):
+    """Turn \r\n and lone \r line endings in data into os.linesep."""
+    if b'\r' in data:
+        data = data.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+    if _LINESEP != b'\n':
+        data = data.replace(b'\n', _LINESEP)
+    return data
+
+def _write_all(out, data):
+    view = memoryview(data)
+    while view:
+        view = view[out.write(view):]
+
+def _copy_range(src, out, offset, length=None):
+    """
+    Copy src (a raw binary file) from offset to its end, or at most length
+    bytes, into out at out's current position. Uses copy_file_range or
+    sendfile where the platform supports them, otherwise reads and writes
+    COPY_CHUNK_SIZE bytes at a time through one reused buffer. Returns the
+    number of bytes copied.
+    """
+    src_fd, out_fd = src.fileno(), out.fileno()
+    copied = 0
+
+    def step():
+        return COPY_CHUNK_SIZE if length is None else min(COPY_CHUNK_SIZE, length - copied)
+
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while True:
+                n = step() and os.copy_file_range(src_fd, out_fd, step(), offset + copied)
+                if n == 0:
+                    return copied
+                copied += n
+        except OSError as e:
+            if e.errno not in _FALLBACK_ERRNOS:
+                raise
+    if hasattr(os, 'sendfile'):
+        try:
+            while True:
+                n = step() and os.sendfile(out_fd, src_fd, offset + copied, step())
+                if n == 0:
+                    return copied
+                copied += n
+        except OSError as e:
+            if e.errno not in _FALLBACK_ERRNOS:
+                raise
+    buffer = bytearray(COPY_CHUNK_SIZE)
+    src.seek(offset + copied)
+    with memoryview(buffer) as view:
+        while True:
+            n = step() and src.readinto(view[:step()])
+            if not n:
+                return copied
+            _write_all(out, view[:n])
+            copied += n
+
+def _unshare(path, keep):
+    """
+    Give path an inode of its own holding its first keep bytes, so writing
+    to it does not change a hardlinked backup snapshot (see backup_store).
+    """
+    try:
+        if os.stat(path).st_nlink < 2:
+            return
+    except OSError:
+        return
+    if not keep:
+        os.remove(path)
+        return
+    tmp = f"{path}.tmp"
+    with open(path, 'rb', buffering=0) as src, open(tmp, 'wb', buffering=0) as out:
+        _copy_range(src, out, 0, keep)
+    shutil.copystat(path, tmp)
+    os.replace(tmp, path)
+
+class MasterWriter:
+    """
+    Writes the master file through a single open handle.
+
+    Files too large to read ahead are streamed into the master file
+    COPY_CHUNK_SIZE bytes at a time, so memory use does not depend on file
+    sizes, and the master file is opened once per run instead of once per
+    file. Line endings are translated like text-mode I/O (see
+    _translate_newlines):
+
+        with MasterWriter(master_filename, log) as writer:
+            writer.write_directory_structure(files)
+            for file in files:
+                writer.append_file(file)
+
+    With offset, the existing master file is cut at offset and written from
+    there instead of being truncated. Every append_file() call adds a
+    section record (see save_sections) to writer.sections; writer.failed is
+    set if a write error left a section incomplete.
+    """
+
+    def __init__(self, master_filename, log, offset=None):
+        self.master_filename = master_filename
+        self.log = log
+        self.sections = []
+        self.failed = False
+        _unshare(master_filename, offset)
+        # Unbuffered, so header writes and zero-copy appends share one file position.
+        if offset is None:
+            self.out = open(master_filename, 'wb', buffering=0)
+        else:
+            self.out = open(master_filename, 'r+b', buffering=0)
+            self.out.truncate(offset)
+            self.out.seek(offset)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def close(self):
+        self.out.close()
+
+    def tell(self):
+        return self.out.tell()
+
+    def write_text(self, text):
+        _write_all(self.out, _translate_newlines(text.encode('utf-8')))
+
+    def write_directory_structure(self, file_list):
+        try:
+            self.write_text("# Directory Structure\n\n" + "".join(f"{file}\n" for file in file_list) + "\n\n")
+            self.log("Directory structure written to master file.")
+        except Exception as e:
+            self.failed = True
+            self.log(f"Error writing directory structure: {e}")
+
+    def append_file(self, filename, prefetched=None):
+        """
+        Append filename with its "# Content from" header. Files that are not
+        UTF-8 are skipped; a streamed file found not to be is cut back out.
+        prefetched is an optional read_ahead() result for filename; without
+        one (or for files too large to read ahead) the file is streamed.
+        Returns True if the file was appended.
+        """
+        offset = self.out.tell()
+        if isinstance(prefetched, FileNotFoundError) or (prefetched is None and not os.path.exists(filename)):
+            self.log(f"File not found: {filename}")
+            return self._section(filename, offset, None, None, False)
+        if isinstance(prefetched, Exception):
+            self.log(f"Error reading {filename}: {prefetched}")
+            return self._section(filename, offset, None, None, False)
+        if prefetched is not None and prefetched[0] is not None:
+            content, state, sha1 = prefetched
+            try:
+                content.decode('utf-8')
+            except UnicodeDecodeError as e:
+                self.log(f"Error reading {filename}: {e}")
+                return self._section(filename, offset, state, None, False)
+            try:
+                self.write_text(f"\n\n# Content from {filename}\n\n")
+                _write_all(self.out, _translate_newlines(content))
+            except Exception as e:
+                return self._write_failed(filename, e)
+            self.log(f"Appended content from {filename}")
+            return self._section(filename, offset, state, sha1, True)
+
+        try:
+            src = open(filename, 'rb', buffering=0)
+        except Exception as e:
+            self.log(f"Error reading {filename}: {e}")
+            return self._section(filename, offset, None, None, False)
+        with src:
+            try:
+                state = _state(os.fstat(src.fileno()))
+            except Exception as e:
+                self.log(f"Error reading {filename}: {e}")
+                return self._section(filename, offset, None, None, False)
+            try:
+                self.write_text(f"\n\n# Content from {filename}\n\n")
+                sha1 = self._stream(src)
+            except UnicodeDecodeError as e:
+                try:
+                    self.out.truncate(offset)
+                    self.out.seek(offset)
+                except Exception as error:
+                    return self._write_failed(filename, error)
+                self.log(f"Error reading {filename}: {e}")
+                return self._section(filename, offset, state, None, False)
+            except Exception as e:
+                return self._write_failed(filename, e)
+        self.log(f"Appended content from {filename}")
+        return self._section(filename, offset, state, sha1, True)
+
+    def _stream(self, src):
+        """
+        Write src, translating line endings, and return the SHA-1 of its
+        bytes. Raises UnicodeDecodeError if src is not UTF-8.
+        """
+        digest = hashlib.sha1()
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        carry = b""
+        data = src.read(COPY_CHUNK_SIZE)
+        while data:
+            digest.update(data)
+            decoder.decode(data)
+            data = carry + data
+            # A \r at the end of a chunk may be the first half of \r\n.
+            carry = b"\r" if data.endswith(b"\r") else b""
+            _write_all(self.out, _translate_newlines(data[:-1] if carry else data))
+            data = src.read(COPY_CHUNK_SIZE)
+        decoder.decode(b"", final=True)
+        _write_all(self.out, _translate_newlines(carry))
+        return digest.hexdigest()
+
+    def _write_failed(self, filename, error):
+        self.failed = True
+        self.log(f"Error appending {filename}: {error}")
+        return False
+
+    def _section(self, filename, offset, state, sha1, appended):
+        self.sections.append({
+            'path': filename,
+            'size': state[0] if state else None,
+            'mtime_ns': state[1] if state else None,
+            'sha1': sha1,
+            'offset': offset,
+            'length': self.out.tell() - offset,
+            'appended': appended,
+        })
+        return appended
+
+def _state(st):
+    return st.st_size, st.st_mtime_ns
+
+def read_ahead(filename, limit):
+    """
+    Read-ahead worker. Returns (content, (size, mtime_ns), sha1) for
+    filename, with content and sha1 None if the file is larger than limit
+    bytes (the writer then streams it), or the exception raised while
+    reading it.
+    """
+    try:
+        with open(filename, 'rb') as f:
+            state = _state(os.fstat(f.fileno()))
+            if state[0] > limit:
+                return None, state, None
+            content = f.read()
+        return content, state, hashlib.sha1(content).hexdigest()
+    except Exception as e:
+        return e
+
+def _write_files(writer, file_list, read_ahead_files, read_ahead_bytes):
+    """
+    Append file_list in order. Up to read_ahead_files files after the one
+    being written are read on a thread pool; each may hold at most
+    read_ahead_bytes / read_ahead_files bytes, so buffered data stays under
+    read_ahead_bytes. Returns the number of files appended.
+    """
+    if read_ahead_files <= 0:
+        return sum(1 for file in file_list if writer.append_file(file))
+    limit = read_ahead_bytes // read_ahead_files
+    appended = 0
+    with ThreadPoolExecutor(max_workers=read_ahead_files) as readers:
+        upcoming = iter(file_list)
+        queued = deque((file, readers.submit(read_ahead, file, limit))
+                       for file in islice(upcoming, read_ahead_files))
+        while queued:
+            file, future = queued.popleft()
+            appended += writer.append_file(file, future.result())
+            del future  # drop the buffered content before reading the next file
+            for next_file in islice(upcoming, 1):
+                queued.append((next_file, readers.submit(read_ahead, next_file, limit)))
+    return appended
+
+# -------------------------------------------------------------------
+# Section manifest for incremental rewrites
+# -------------------------------------------------------------------
+def sections_filename(master_filename):
+    return f"{master_filename}.sections.json"
+
+def save_sections(master_filename, file_list, sections):
+    """
+    Record where each file's section lives in master_filename (path, size,
+    mtime_ns, sha1, offset, length) together with the master file's own
+    size and mtime, so a later run can tell which sections are still valid.
+    """
+    st = os.stat(master_filename)
+    data = {
+        'files': list(file_list),
+        'master_size': st.st_size,
+        'master_mtime_ns': st.st_mtime_ns,
+        'sections': sections,
+    }
+    tmp = sections_filename(master_filename) + ".tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    os.replace(tmp, sections_filename(master_filename))
+
+def load_sections(master_filename):
+    """Return the saved section manifest for master_filename, or None."""
+    try:
+        with open(sections_filename(master_filename), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _file_sha1(path, start=0, length=None):
+    digest = hashlib.sha1()
+    buffer = bytearray(COPY_CHUNK_SIZE)
+    with open(path, 'rb', buffering=0) as f, memoryview(buffer) as view:
+        f.seek(start)
+        remaining = length
+        while remaining is None or remaining > 0:
+            n = f.readinto(buffer if remaining is None or remaining >= len(buffer) else view[:remaining])
+            if not n:
+                break
+            digest.update(view[:n])
+            if remaining is not None:
+                remaining -= n
+    return digest.hexdigest()
+
+def _section_unchanged(master_filename, section):
+    """
+    True if section still matches its source file. Unchanged size and
+    mtime are trusted; if only the mtime moved, the content hash decides
+    (hashing the section in the master file if none was recorded), and the
+    section's mtime is updated so the file is not hashed again.
+    """
+    try:
+        state = _state(os.stat(section['path']))
+    except OSError:
+        state = None
+    recorded = (section['size'], section['mtime_ns']) if section['size'] is not None else None
+    if state == recorded:
+        return True
+    if state is None or recorded is None or state[0] != recorded[0] or not section['appended']:
+        return False
+    sha1 = section['sha1']
+    if sha1 is None:
+        # Manifests written before streamed files were hashed; only valid if
+        # the file needed no line ending translation.
+        header = len(_translate_newlines(f"\n\n# Content from {section['path']}\n\n".encode('utf-8')))
+        sha1 = _file_sha1(master_filename, section['offset'] + header, section['length'] - header)
+    if _file_sha1(section['path']) != sha1:
+        return False
+    section['sha1'] = sha1
+    section['mtime_ns'] = state[1]
+    return True
+
+def first_changed_section(master_filename, file_list, manifest):
+    """
+    Return the index of the first file whose section in master_filename is
+    out of date (len(file_list) if none is), or None if the master file
+    cannot be reused at all (different file list, or the master file was
+    changed outside this tool).
+    """
+    if manifest is None or manifest.get('files') != list(file_list):
+        return None
+    sections = manifest['sections']
+    try:
+        st = os.stat(master_filename)
+    except OSError:
+        return None
+    if (st.st_size, st.st_mtime_ns) != (manifest['master_size'], manifest['master_mtime_ns']):
+        return None
+    for index, section in enumerate(sections):
+        if not _section_unchanged(master_filename, section):
+            return index
+    return len(sections)
+
+def concatenate(master_filename, file_list, log, read_ahead_files=READ_AHEAD_FILES,
+                read_ahead_bytes=READ_AHEAD_BYTES, incremental=True):
+    """
+    Write master_filename as the directory structure followed by the content
+    of every file in file_list, in order, through one handle (see
+    MasterWriter and _write_files).
+
+    With incremental, a section manifest saved by the previous run is used
+    to keep the unchanged leading sections: the master file is cut at the
+    first changed file and only the rest is rewritten. Otherwise (or if the
+    file list or master file changed) it is rewritten from scratch.
+    Returns the number of files appended, or None if the master file could
+    not be opened.
+    """
+    manifest = load_sections(master_filename) if incremental else None
+    start = first_changed_section(master_filename, file_list, manifest)
+    if start is not None and start == len(file_list):
+        log("Master file is up to date; no files changed.")
+        save_sections(master_filename, file_list, manifest['sections'])
+        return sum(1 for section in manifest['sections'] if section['appended'])
+
+    try:
+        if start is None:
+            writer = MasterWriter(master_filename, log)
+            kept = []
+        else:
+            kept = manifest['sections'][:start]
+            writer = MasterWriter(master_filename, log, offset=manifest['sections'][start]['offset'])
+    except Exception as e:
+        log(f"Error clearing master file: {e}")
+        return None
+    with writer:
+        if start is None:
+            log("Cleared existing master file.")
+            writer.write_directory_structure(file_list)
+        else:
+            log(f"Keeping {start} unchanged file(s); rewriting from {file_list[start]}.")
+        appended = _write_files(writer, file_list[len(kept):], read_ahead_files, read_ahead_bytes)
+    if writer.failed:
+        # A partial section must not be trusted by the next run.
+        try:
+            os.remove(sections_filename(master_filename))
+        except OSError:
+            pass
+    else:
+        save_sections(master_filename, file_list, kept + writer.sections)
+    return appended + sum(1 for section in kept if section['appended'])